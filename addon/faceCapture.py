@@ -17,7 +17,8 @@ from bpy_extras.object_utils import AddObjectHelper
 from bpy.props import (
     FloatProperty,
     IntProperty,
-    BoolProperty
+    BoolProperty,
+    EnumProperty
 )
 
 import importlib
@@ -52,14 +53,65 @@ class VIEW3D_face_capture_menu(bpy.types.Panel):
         row.prop(fc,'fps')
         row.enabled = not fc.is_fc_on
         
-        # Camera device index
+        # Frame source: camera device index, video file or image directory
+        if fc.capture_mode != 'REPLAY':
+            row = col.row()
+            row.prop(fc,'frame_source')
+            row.enabled = not fc.is_fc_on
+
+            row = col.row()
+            if fc.frame_source == 'CAMERA':
+                row.prop(fc,'camera_index')
+            else:
+                row.prop(fc,'source_path')
+            row.enabled = not fc.is_fc_on
+
+        # Capture mode
         row = col.row()
-        row.prop(fc,'camera_index')
+        row.prop(fc,'capture_mode')
         row.enabled = not fc.is_fc_on
 
+        # Region and resolution fed to landmark detection
+        if fc.capture_mode != 'REPLAY':
+            row = col.row()
+            row.prop(fc,'roi_tracking')
+            row.enabled = not fc.is_fc_on
+            row = col.row()
+            row.prop(fc,'inference_size')
+            row.enabled = not fc.is_fc_on
+            row = col.row()
+            row.prop(fc,'max_faces')
+            row.enabled = not fc.is_fc_on
+
+        # Landmark recording, written while capturing or played back
+        if fc.capture_mode == 'REPLAY':
+            col.prop(fc, 'recording_path')
+            col.prop(fc, 'replay_realtime')
+        else:
+            row = col.row()
+            row.prop(fc, 'record_landmarks')
+            row.enabled = not fc.is_fc_on
+            if fc.record_landmarks:
+                col.prop(fc, 'recording_path')
+
         # Automatic keyframe insertion
         row = col.row()
         row.prop(fc,'auto_insert')
+        if fc.auto_insert:
+            col.prop(fc, 'keyframe_flush_frames')
+            col.prop(fc, 'keyframe_tolerance')
+
+        # Temporal filtering of landmarks and weights
+        row = col.row()
+        row.prop(fc, 'landmark_filter')
+        if fc.landmark_filter == 'ONE_EURO':
+            col.prop(fc, 'filter_min_cutoff')
+            col.prop(fc, 'filter_beta')
+        elif fc.landmark_filter == 'KALMAN':
+            col.prop(fc, 'filter_process_noise')
+            col.prop(fc, 'filter_measurement_noise')
+        if fc.landmark_filter != 'NONE':
+            col.prop(fc, 'filter_weights')
 
         # Open window to show captured image
         row = col.row()
@@ -79,10 +131,48 @@ class VIEW3D_face_capture_menu(bpy.types.Panel):
                  text= 'Stop capture' if fc.is_fc_on else "Init capture"
                  )
 
+        # Profiling: live fps and per-stage timings
+        box = layout.box()
+        row = box.row()
+        row.prop(fc, 'profiling')
+        row.prop(fc, 'profile_trace')
+        profiler = face_capture_modal.profiling.get_profiler()
+        if fc.profiling and profiler is not None:
+            box.label(text="{:.1f} fps".format(profiler.fps()))
+            grid = box.grid_flow(columns=4, even_columns=True, align=True)
+            for label in ("Stage", "p50 ms", "p95 ms", "p99 ms"):
+                grid.label(text=label)
+            for name, (count, p50, p95, p99) in profiler.summary().items():
+                grid.label(text=name)
+                grid.label(text="{:.2f}".format(p50))
+                grid.label(text="{:.2f}".format(p95))
+                grid.label(text="{:.2f}".format(p99))
+            for stage, stats in profiler.counters.items():
+                box.label(text=stage + ": " + "  ".join("{} {}".format(k, v) for k, v in stats.items()))
+            if fc.profile_trace:
+                row = box.row()
+                row.prop(fc, 'trace_path', text="")
+                row.operator("landmark.export_trace", text="", icon='EXPORT')
+
 def toggle_fc(self, context):
     if context.scene.fc_settings.is_fc_on:
         bpy.ops.landmark.facecapture()
 
+def toggle_profiling(self, context):
+    fc = context.scene.fc_settings
+    if fc.profiling:
+        face_capture_modal.profiling.enable(trace=fc.profile_trace)
+    else:
+        face_capture_modal.profiling.disable()
+
+def invalidate_landmark_binding(self, context):
+    face_capture_modal.landmark_retarget.invalidate_mappings()
+
+def toggle_trace(self, context):
+    profiler = face_capture_modal.profiling.get_profiler()
+    if profiler is not None:
+        profiler.trace = context.scene.fc_settings.profile_trace
+
 class FaceCapureSettings(bpy.types.PropertyGroup):
     fps: bpy.props.FloatProperty(
         default=30,
@@ -94,6 +184,67 @@ class FaceCapureSettings(bpy.types.PropertyGroup):
         name="Camera",
         description="Camera device index used in capture",
     )
+    frame_source: EnumProperty(
+        name="Source",
+        description="Where captured frames come from",
+        items=(
+            ('CAMERA', "Camera", "Capture from a camera device"),
+            ('VIDEO', "Video file", "Capture from a video file, played at its frame rate"),
+            ('IMAGES', "Image sequence", "Capture from the images of a directory, in name order"),
+        ),
+        default='CAMERA',
+    )
+    source_path: bpy.props.StringProperty(
+        default="",
+        name="Path",
+        description="Video file or image directory to capture from",
+        subtype='FILE_PATH',
+    )
+    capture_mode: EnumProperty(
+        name="Capture mode",
+        description="Where camera read and landmark detection run",
+        items=(
+            ('SYNC', "Synchronous", "Capture and detect landmarks inside Blender's timer event"),
+            ('THREAD', "Background thread", "Capture and detect landmarks in a worker thread, Blender only applies the latest result"),
+            ('PROCESS', "Separate process", "Capture and detect landmarks in a worker process, landmarks are shared through shared memory"),
+            ('REPLAY', "Replay recording", "Play back a landmark recording instead of capturing from the camera"),
+        ),
+        default='SYNC',
+    )
+    roi_tracking: BoolProperty(
+        default=False,
+        name="Track face region",
+        description="Detect landmarks only in the region around the face found in the previous frame",
+    )
+    inference_size: IntProperty(
+        default=0,
+        min=0,
+        name="Inference size",
+        description="Longest side of the image given to landmark detection, larger frames or regions are downscaled (0 keeps the full resolution)",
+    )
+    max_faces: IntProperty(
+        default=1,
+        min=1,
+        max=8,
+        name="Faces",
+        description="Faces detected per frame, solved together; the first one drives the mesh and region tracking needs a single face",
+    )
+    record_landmarks: BoolProperty(
+        default=False,
+        name="Record landmarks",
+        description="Write captured landmarks to the recording directory",
+    )
+    recording_path: bpy.props.StringProperty(
+        default="//landmarks",
+        name="Recording",
+        description="Directory landmark takes are recorded into, one subdirectory per take. Replay plays this take, or the latest take inside it",
+        subtype='DIR_PATH',
+    )
+    replay_realtime: BoolProperty(
+        default=True,
+        name="Real time",
+        description="Replay frames at their recorded times, otherwise one frame per update",
+    )
     is_fc_on: BoolProperty(
         default=False,
         name="Capture state",
@@ -105,11 +256,82 @@ class FaceCapureSettings(bpy.types.PropertyGroup):
         name="Insert keyframes",
         description="Controls automatic insertion of keyframes",
     )
+    keyframe_flush_frames: IntProperty(
+        default=0,
+        min=0,
+        name="Flush interval",
+        description="Captured frames buffered before their keyframes are written (0 writes them when capture stops)",
+    )
+    keyframe_tolerance: FloatProperty(
+        default=0.0,
+        min=0.0,
+        precision=4,
+        name="Keyframe tolerance",
+        description="Drop keyframes within this distance of the line through their neighbours (0 keeps every keyframe)",
+    )
     show_cam: BoolProperty(
         default=False,
         name="Show image",
         description="Controls exhibition of the imagem used for face capture",
     )
+    landmark_filter: EnumProperty(
+        name="Filter",
+        description="Temporal filter applied to the landmarks before they reach the mesh and the solver",
+        items=(
+            ('NONE', "None", "Use the landmarks as captured"),
+            ('ONE_EURO', "One Euro", "Low pass whose cutoff rises with speed: smooth when still, little lag when moving"),
+            ('KALMAN', "Kalman", "Constant velocity Kalman filter"),
+        ),
+        default='NONE',
+    )
+    filter_min_cutoff: FloatProperty(
+        default=1.0,
+        min=0.01,
+        name="Min cutoff",
+        description="Cutoff frequency in Hz while still, lower is smoother but lags more",
+    )
+    filter_beta: FloatProperty(
+        default=0.1,
+        min=0.0,
+        name="Speed coefficient",
+        description="How much the cutoff rises with speed, higher reduces lag on fast motion",
+    )
+    filter_process_noise: FloatProperty(
+        default=10.0,
+        min=0.0,
+        name="Process noise",
+        description="Expected variation of the velocity, higher follows motion faster",
+    )
+    filter_measurement_noise: FloatProperty(
+        default=0.01,
+        min=1e-6,
+        precision=4,
+        name="Measurement noise",
+        description="Expected variance of the captured values, higher is smoother but lags more",
+    )
+    filter_weights: BoolProperty(
+        default=False,
+        name="Filter weights",
+        description="Also filter the solved shape key weights, with the same filter settings",
+    )
+    profiling: BoolProperty(
+        default=False,
+        name="Profile",
+        description="Time every capture stage and show the breakdown",
+        update=toggle_profiling
+    )
+    profile_trace: BoolProperty(
+        default=False,
+        name="Trace",
+        description="Also keep every timed span for export as a Chrome trace",
+        update=toggle_trace
+    )
+    trace_path: bpy.props.StringProperty(
+        default="//facecapture_trace.json",
+        name="Trace file",
+        description="Chrome trace (JSON) the profiled spans are exported to",
+        subtype='FILE_PATH',
+    )
     landmark_mesh: bpy.props.PointerProperty(
         name="Landmarks mesh", 
         description="Mesh with tracked landmark points",
@@ -126,6 +348,44 @@ class FaceCapureSettings(bpy.types.PropertyGroup):
         type=bpy.types.Object
     )
 
+    retarget_mode: EnumProperty(
+        name="Retarget with",
+        description="How captured expressions are transferred to the target mesh",
+        items=(
+            ('SHAPE_KEYS', "Conversion values", "Drive the target shape keys from the blendshape mesh weights"),
+            ('LANDMARKS', "Landmark triangles", "Deform the target vertices from the landmark mesh triangles they are bound to"),
+        ),
+        default='SHAPE_KEYS',
+    )
+    retarget_falloff: FloatProperty(
+        default=0.0,
+        min=0.0,
+        name="Falloff radius",
+        description="Distance from the landmark surface over which bound vertices fade out, applied by Bind to Landmarks (0 binds every vertex fully); changing it requires binding again",
+        update=invalidate_landmark_binding
+    )
+
+    retarget_fit: EnumProperty(
+        name="Fit from",
+        description="What Solve All Conversion Values fits the conversion values to",
+        items=(
+            ('POSES', "Pose pairs", "Source and target shape key values stored with Add Pose Pair"),
+            ('GEOMETRY', "Key shapes", "Deltas of the source keys matched to target key deltas at the nearest target vertices"),
+        ),
+        default='POSES',
+    )
+    retarget_regularization: FloatProperty(
+        default=1e-3,
+        min=0.0,
+        precision=5,
+        name="Regularization",
+        description="Weight of the penalty on large conversion values, relative to the scale of the samples",
+    )
+    live_retarget: BoolProperty(
+        default=False,
+        name="Retarget while capturing",
+        description="Retarget the target mesh on every captured frame",
+    )
     retarget_shape_key: bpy.props.StringProperty(
         default="Basis",
         name="Retarget Blendshape",
@@ -136,6 +396,54 @@ class FaceCapureSettings(bpy.types.PropertyGroup):
         name="Tolerance",
         description="Tolerance used in automatic insertion of shape keys",
     )
+    insertion_mode: EnumProperty(
+        name="Insertion",
+        description="How captured expressions are chosen to become new shape keys",
+        items=(
+            ('RESIDUAL', "Residual", "Insert when the weight solve error is above the tolerance"),
+            ('NOVELTY', "Novelty", "Insert when the expression is far from every expression already stored"),
+        ),
+        default='RESIDUAL',
+    )
+    novelty_threshold: FloatProperty(
+        default=0.25,
+        min=0.0,
+        name="Novelty threshold",
+        description="Mean landmark distance to the nearest stored expression above which a new one is inserted",
+    )
+    min_key_spacing: IntProperty(
+        default=15,
+        min=0,
+        name="Minimum spacing",
+        description="Minimum number of captured frames between two automatic insertions",
+    )
+    max_shape_keys: IntProperty(
+        default=0,
+        min=0,
+        name="Maximum shape keys",
+        description="Evict the most redundant expression above this many shape keys (0 for no limit)",
+    )
+    solver: EnumProperty(
+        name="Solver",
+        description="Method used to find the shape key weights",
+        items=(
+            ('LSTSQ', "Least squares", "Unconstrained least squares weights"),
+            ('BOUNDED', "Bounded", "Weights kept in [0, 1], with optional regularization and temporal smoothing"),
+        ),
+        default='LSTSQ',
+    )
+    regularization: FloatProperty(
+        default=0.0,
+        min=0.0,
+        name="Regularization",
+        description="Penalty on large shape key weights used by the bounded solver",
+    )
+    temporal_weight: FloatProperty(
+        default=0.0,
+        min=0.0,
+        name="Temporal weight",
+        description="Penalty on weight changes from the previous frame used by the bounded solver",
+    )
 
 class duplicate_and_assign(bpy.types.Operator):
     '''Creates a copy of landmarks mesh and assign it to blendshape mesh'''
@@ -153,34 +461,32 @@ class duplicate_and_assign(bpy.types.Operator):
 
         return {'FINISHED'}
 
-class add_shape_keys(bpy.types.Operator):
-    '''Add current face expression as a shape key'''
-    bl_idname = "landmark.add_shape_keys"
-    bl_label = "Add Shape Key"  
+class export_trace(bpy.types.Operator):
+    '''Export profiled capture spans as a Chrome trace'''
+    bl_idname = "landmark.export_trace"
+    bl_label = "Export Trace"
 
     def execute(self, context):
         fc = context.scene.fc_settings
+        profiler = face_capture_modal.profiling.get_profiler()
+        if profiler is None:
+            self.report({'WARNING'}, "Profiling is off")
+            return {'CANCELLED'}
 
-        bpy.context.view_layer.objects.active = fc.blendshape_mesh
-        fc.landmark_mesh.select_set(True)
+        path = bpy.path.abspath(fc.trace_path)
+        count = profiler.export_chrome_trace(path)
+        self.report({'INFO'}, "{} spans written to {}".format(count, path))
 
-        n = 0
+        return {'FINISHED'}
 
-        for group in fc.blendshape_mesh.vertex_groups:
-            # if group is empty, ignore it
-            if not any(group.index in [g.group for g in v.groups] for v in fc.blendshape_mesh.data.vertices):
-                continue
+class add_shape_keys(bpy.types.Operator):
+    '''Add current face expression as a shape key'''
+    bl_idname = "landmark.add_shape_keys"
+    bl_label = "Add Shape Key"  
 
-            bpy.ops.object.join_shapes()
-            shape_key = fc.blendshape_mesh.data.shape_keys.key_blocks[-1]
-            shape_key.name = 'key_' + group.name
-            shape_key.vertex_group = group.name
-            n = n+1
-        
-        if n == 0:
-            bpy.ops.object.join_shapes()
-            shape_key = fc.blendshape_mesh.data.shape_keys.key_blocks[-1]
-            shape_key.name = 'key'
+    def execute(self, context):
+        fc = context.scene.fc_settings
+        face_capture_modal.add_shape_keys(fc)
 
         return {'FINISHED'}
 
@@ -203,10 +509,24 @@ class VIEW3D_shape_keys_menu(bpy.types.Panel):
         row.use_property_split = True
         row.prop(fc,'blendshape_mesh')
 
-        # Automatic shape key insertion tolerance
-        row = layout.row()
-        row.use_property_split = True
-        row.prop(fc, 'tolerance')
+        # Automatic shape key insertion
+        col = layout.column()
+        col.use_property_split = True
+        col.prop(fc, 'insertion_mode')
+        if fc.insertion_mode == 'NOVELTY':
+            col.prop(fc, 'novelty_threshold')
+            col.prop(fc, 'min_key_spacing')
+            col.prop(fc, 'max_shape_keys')
+        else:
+            col.prop(fc, 'tolerance')
+
+        # Weight solver
+        col = layout.column()
+        col.use_property_split = True
+        col.prop(fc, 'solver')
+        if fc.solver == 'BOUNDED':
+            col.prop(fc, 'regularization')
+            col.prop(fc, 'temporal_weight')
 
         # Add or assign button
         row = layout.row()
@@ -237,6 +557,20 @@ class VIEW3D_retargeting_menu(bpy.types.Panel):
         row = col.row()
         row.prop(fc,'retarget_mesh')
 
+        row = col.row()
+        row.prop(fc, 'retarget_mode')
+
+        if fc.retarget_mode == 'LANDMARKS':
+            col.prop(fc, 'retarget_falloff')
+            row = layout.row()
+            row.scale_y = 2.
+            row.enabled = fc.landmark_mesh is not None and fc.retarget_mesh is not None
+            row.operator("retarget.bind_landmarks")
+
+            row = layout.row()
+            row.prop(fc, 'live_retarget')
+            return
+
         # Current blendshape
         if fc.blendshape_mesh is not None and fc.blendshape_mesh.data.shape_keys is not None:
             row = col.row()
@@ -247,12 +581,34 @@ class VIEW3D_retargeting_menu(bpy.types.Panel):
         row.scale_y = 2.
         row.operator("retarget.blendshapes_single")
 
+        # Fit every conversion value at once
+        col = layout.column()
+        col.use_property_split = True
+        col.prop(fc, 'retarget_fit')
+        col.prop(fc, 'retarget_regularization')
+        if fc.retarget_fit == 'POSES':
+            # pose pairs live on the blendshape mesh keys, recording needs the target keys too
+            row = layout.row(align=True)
+            row.enabled = Blendshape_retarget_manual.has_shape_keys(fc.blendshape_mesh)
+            sub = row.row(align=True)
+            sub.enabled = Blendshape_retarget_manual.has_shape_keys(fc.retarget_mesh)
+            sub.operator("retarget.record_pose")
+            row.operator("retarget.clear_poses", text="", icon='TRASH')
+        row = layout.row()
+        row.operator("retarget.blendshapes_all")
+
         # Apply changes to final model
         row = layout.row()
         row.operator("retarget.blendshapes_update")
 
-__classes__ = (face_capture_modal.FaceCaptureModal, VIEW3D_face_capture_menu, FaceCapureSettings, duplicate_and_assign, add_shape_keys,
-            VIEW3D_shape_keys_menu, Blendshape_retarget_manual.Blendshape_retarget_single_blendshape, Blendshape_retarget_manual.Blendshape_target_update, VIEW3D_retargeting_menu)
+        # Retarget every captured frame
+        row = layout.row()
+        row.prop(fc, 'live_retarget')
+
+__classes__ = (face_capture_modal.FaceCaptureModal, VIEW3D_face_capture_menu, FaceCapureSettings, duplicate_and_assign, export_trace, add_shape_keys,
+            VIEW3D_shape_keys_menu, Blendshape_retarget_manual.Blendshape_retarget_single_blendshape, Blendshape_retarget_manual.Blendshape_target_update,
+            Blendshape_retarget_manual.Blendshape_retarget_manual, Blendshape_retarget_manual.Blendshape_record_pose, Blendshape_retarget_manual.Blendshape_clear_poses, Blendshape_retarget_manual.Blendshape_bind_landmarks,
+            VIEW3D_retargeting_menu)
 
 def register():
     for cls in __classes__:
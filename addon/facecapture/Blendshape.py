@@ -1,29 +1,238 @@
 import numpy as np
 
 class BlendshapeMesh:
+    # number of incremental key updates before the cached system is rebuilt
+    # from scratch to flush accumulated rounding errors
+    refactor_interval = 32
+
     def __init__(self, data):
+        data = np.asarray(data, dtype=np.float64)
         self.basis = data[0]
-        self.dif = data[1:] - self.basis
-        nb, nv, _ = self.dif.shape
+        nb, nv, _ = data[1:].shape
+
+        # key deltas, pseudo-inverse and gram matrix live in buffers with
+        # spare rows so keys can be appended without reallocating every time
+        self._capacity = max(nb, 8)
+        self._dif = np.empty((self._capacity, nv, 3))
+        self._pinv = np.empty((self._capacity, 3 * nv))
+        self._gram = np.empty((self._capacity, self._capacity))
+        self._dif[:nb] = data[1:] - self.basis
+
+        self._set_count(nb)
         self.weights = np.zeros(nb)
+        self.converged = True
+        self.factorize()
+
+    def _set_count(self, nb):
+        self.dif = self._dif[:nb]
+        # (3*nv, nb) key delta matrix, a view of the deltas
+        self._A = self.dif.reshape(nb, self.basis.size).T
+
+    def _rcond(self):
+        # same cutoff as np.linalg.lstsq(rcond=None)
+        return np.finfo(np.float64).eps * max(self._A.shape)
+
+    def _grow(self):
+        nb = self.dif.shape[0]
+        capacity = 2 * self._capacity
+
+        dif = np.empty((capacity,) + self._dif.shape[1:])
+        dif[:nb] = self.dif
+        pinv = np.empty((capacity, self._pinv.shape[1]))
+        pinv[:nb] = self._pinv[:nb]
+        gram = np.empty((capacity, capacity))
+        gram[:nb, :nb] = self._gram[:nb, :nb]
+
+        self._capacity = capacity
+        self._dif, self._pinv, self._gram = dif, pinv, gram
+        self._set_count(nb)
+
+    # Caches the pseudo-inverse of the (3*nv, nb) key delta matrix A
+    # and the gram matrix used by get_weights_bounded
+    def factorize(self):
+        nb = self.dif.shape[0]
+        self._pinv[:nb] = np.linalg.pinv(self._A, rcond=self._rcond())
+        self._gram[:nb, :nb] = self._A.T @ self._A
+        self._updates = 0
+
+    # Appends a shape key given its (nv, 3) coordinates
+    # The pseudo-inverse gets a rank-1 column update (Greville) instead of a
+    # new factorization, so the cost only grows linearly with the key count
+    def append_key(self, coords):
+        nb = self.dif.shape[0]
+        if nb == self._capacity:
+            self._grow()
+
+        A, P = self._A, self._pinv[:nb]
+        a = (np.asarray(coords, dtype=np.float64) - self.basis).reshape(-1)
+
+        d = P @ a
+        c = a - A @ d
+        if np.sqrt(c @ c) > self._rcond() * np.sqrt(a @ a):
+            # new key is independent from the others
+            b = c / (c @ c)
+        else:
+            b = (P.T @ d) / (1.0 + d @ d)
+
+        P -= np.outer(d, b)
+        self._pinv[nb] = b
+
+        column = A.T @ a
+        self._gram[:nb, nb] = column
+        self._gram[nb, :nb] = column
+        self._gram[nb, nb] = a @ a
+
+        self._dif[nb] = a.reshape(self.basis.shape)
+        self._set_count(nb + 1)
+        self.weights = np.append(self.weights, 0.0)
+
+        self._updates += 1
+        if self._updates >= self.refactor_interval:
+            self.factorize()
+
+    # Removes the shape key at index (0 is the first key after the basis)
+    def remove_key(self, index):
+        nb = self.dif.shape[0]
+        P = self._pinv[:nb]
+        a = self._A[:, index]
+        g = P[index].copy()
+        G = np.delete(P, index, axis=0)
+
+        ga = g @ a
+        if abs(1.0 - ga) < 1e-8:
+            # removed key was independent from the others
+            G -= np.outer(G @ g, g) / (g @ g)
+        else:
+            G += np.outer(G @ a, g) / (1.0 - ga)
+
+        self._pinv[:nb - 1] = G
+        self._dif[index:nb - 1] = self._dif[index + 1:nb]
+        gram = np.delete(np.delete(self._gram[:nb, :nb], index, axis=0), index, axis=1)
+        self._gram[:nb - 1, :nb - 1] = gram
+
+        self._set_count(nb - 1)
+        self.weights = np.delete(self.weights, index)
+
+        self._updates += 1
+        if self._updates >= self.refactor_interval:
+            self.factorize()
 
     def vertices(self, weights):
         return self.basis + np.tensordot(weights, self.dif, axes=((0, 0)))
 
-    def get_weights(self, landmarks):
+    # Minimizes ||Ax-b||^2 with the cached pseudo-inverse
+    # returns the weights and, if residual is set, the squared residual
+    def get_weights(self, landmarks, residual=True):
+        nb, nv, nd = self.dif.shape
+        # also takes flat or np.matrix landmarks
+        landmarks = np.asarray(landmarks, dtype=np.float64).reshape(nv, nd)
+
+        if nb == 0:
+            error = self.__costFunction(self.basis, landmarks)
+            return self.weights, error
+
+        B = (landmarks-self.basis).reshape(-1)
+        x = self._pinv[:nb] @ B
+
+        error = None
+        if residual:
+            r = self._A @ x - B
+            error = r @ r
+
+        return x, error
+
+    # get_weights for a (n, nv, 3) stack of landmarks in one matrix product
+    # returns (n, nb) weights and (n,) squared residuals
+    def get_weights_batch(self, landmarks):
+        nb = self.dif.shape[0]
+        B = (np.asarray(landmarks) - self.basis).reshape(len(landmarks), -1)
+
+        if nb == 0:
+            return np.zeros((len(B), 0)), np.einsum('ij,ij->i', B, B)
+
+        X = B @ self._pinv[:nb].T
+        R = X @ self._A.T - B
+        return X, np.einsum('ij,ij->i', R, R)
+
+    # Minimizes ||Ax-b||^2 + regularization ||x||^2 + temporal ||x-x_prev||^2
+    # subject to lower <= x <= upper, where x_prev are the last solved weights.
+    # Primal active-set solve on the cached gram matrix, warm-started from the
+    # bounds hit by x_prev, so only a couple of iterations are needed while the
+    # expression changes smoothly. Every iteration fixes or releases a single
+    # weight and x stays inside the box, so when the iteration limit (default
+    # 2 * nb + 10) is reached the weights are feasible but may not be optimal;
+    # converged tells which one it was.
+    def get_weights_bounded(self, landmarks, lower=0.0, upper=1.0, regularization=0.0, temporal=0.0,
+                            iterations=None, residual=True):
         nb, nv, nd = self.dif.shape
+        landmarks = np.asarray(landmarks, dtype=np.float64).reshape(nv, nd)
 
         if nb == 0:
+            self.converged = True
             error = self.__costFunction(self.basis, landmarks)
             return self.weights, error
 
-        A = self.dif.transpose(1, 2, 0).reshape(-1,nb)
-        B = (landmarks-self.basis).reshape(-1,1)
+        if iterations is None:
+            iterations = 2 * nb + 10
+
+        B = (landmarks-self.basis).reshape(-1)
+        H = self._gram[:nb, :nb] + (regularization + temporal) * np.eye(nb)
+        c = self._A.T @ B + temporal * self.weights
+
+        x = np.clip(self.weights, lower, upper)
+        at_lower = x <= lower
+        at_upper = x >= upper
+        self.converged = False
+        for _ in range(iterations):
+            free = ~(at_lower | at_upper)
+            x[at_lower] = lower
+            x[at_upper] = upper
+
+            target = x.copy()
+            if np.any(free):
+                rhs = c[free] - H[np.ix_(free, ~free)] @ x[~free]
+                try:
+                    target[free] = np.linalg.solve(H[np.ix_(free, free)], rhs)
+                except np.linalg.LinAlgError:
+                    target[free] = np.linalg.lstsq(H[np.ix_(free, free)], rhs, rcond=None)[0]
+
+            # step towards the subproblem minimum up to the first bound in
+            # the way, which joins the active set
+            step = target - x
+            with np.errstate(divide='ignore', invalid='ignore'):
+                limit = np.where(step < 0, (lower - x) / step, np.where(step > 0, (upper - x) / step, np.inf))
+            limit[~free] = np.inf
+            blocking = np.argmin(limit)
+            if limit[blocking] < 1.0:
+                x += limit[blocking] * step
+                if step[blocking] < 0:
+                    at_lower[blocking] = True
+                else:
+                    at_upper[blocking] = True
+                continue
+            x = target
+
+            # release the bounded weight whose gradient points furthest into
+            # the box; none left means x is optimal
+            gradient = H @ x - c
+            violation = np.where(at_lower, -gradient, 0.0) + np.where(at_upper, gradient, 0.0)
+            release = np.argmax(violation)
+            if violation[release] <= 0:
+                self.converged = True
+                break
+            at_lower[release] = False
+            at_upper[release] = False
+
+        # the steps can overshoot the bounds by rounding errors
+        x = np.clip(x, lower, upper)
+        self.weights = x
 
-        # Calculate minimization of ||Ax-b||^2
-        x, residuals, rank, s = np.linalg.lstsq(A, B, rcond = None)
+        error = None
+        if residual:
+            r = self._A @ x - B
+            error = r @ r
 
-        return x, residuals
+        return x, error
 
     def __costFunction(self, obj1, obj2) :
         D = obj1 - obj2
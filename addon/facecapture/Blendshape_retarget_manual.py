@@ -1,6 +1,8 @@
 import bpy
 import numpy
 
+from . import landmark_retarget
+
 
 def main(context):
     for ob in context.scene.objects:
@@ -19,7 +21,7 @@ def get_vals (obj):
     source = tuple(zip(names, values)) 
     return source
 
-def calculate_shape_key_weights (target, source = {}, simpified = True):
+def calculate_shape_key_weights (target, source = {}, simpified = True, regularization = 1e-3):
     # source and target are both 1d collum arrays
     # we want to find and a, so that Source * a = Target
     # Source cannot be inverted, so we must solve a system
@@ -29,22 +31,229 @@ def calculate_shape_key_weights (target, source = {}, simpified = True):
         # hence, we'll create a 1d array, for the line we'll replace in the final matrix. 
         pos = next((i for i, x in enumerate(source) if x!= 0), None) #find the position of first non zero element.
         return (target/source[pos]), pos 
-    return #numpy.dot(source.transpose(),target.transpose())
+    # otherwise every row of source and target is one pose (a single pose if
+    # they are 1d) and the whole (target keys, source keys) matrix is fitted
+    source = numpy.atleast_2d(source)
+    target = numpy.atleast_2d(target)
+    return solve_conversion(source, target, regularization), None
+
+# Ridge least-squares fit of the conversion matrix from paired samples
+# source (n, ns) and target (n, nt) hold one sample per row; returns M (nt, ns)
+# minimising ||source M^T - target||^2 + regularization ||M||^2, solved for
+# every target key at once. regularization is relative to the mean of the
+# gram diagonal, so it does not depend on the scale of the samples
+def solve_conversion(source, target, regularization=1e-3):
+    source = numpy.asarray(source, dtype=numpy.float64)
+    target = numpy.asarray(target, dtype=numpy.float64)
+
+    gram = source.T @ source
+    scale = numpy.trace(gram) / max(len(gram), 1)
+    gram[numpy.diag_indices_from(gram)] += regularization * (scale if scale > 0 else 1.0)
+    return numpy.linalg.solve(gram, source.T @ target).T
+
+# Index of the nearest target point for every point, brute force in chunks
+def nearest_vertices(points, targets, chunk=256):
+    nearest = numpy.empty(len(points), dtype=numpy.int64)
+    target_norms = numpy.einsum('ij,ij->i', targets, targets)
+    for start in range(0, len(points), chunk):
+        p = points[start:start + chunk]
+        distances = target_norms[None, :] - 2 * p @ targets.T
+        nearest[start:start + chunk] = numpy.argmin(distances, axis=1)
+    return nearest
+
+# World space basis and key deltas, (nverts, 3) and (nkeys, nverts, 3)
+def world_deltas(obj):
+    from .face_capture_modal import convertBlenderObj
+
+    coords = convertBlenderObj(obj).astype(numpy.float64)
+    world = numpy.array(obj.matrix_world)
+    basis = coords[0] @ world[:3, :3].T + world[:3, 3]
+    deltas = (coords[1:] - coords[0]) @ world[:3, :3].T
+    return basis, deltas
+
+# Conversion matrix from the shape of the keys: every source key is written
+# as the combination of target keys whose deltas best match its own at the
+# target vertices nearest to the source vertices. Both meshes are compared in
+# world space, so the source mesh must be placed over the target face
+def fit_conversion_geometry(source_mesh, target_mesh, regularization=1e-3):
+    source_basis, source_deltas = world_deltas(source_mesh)
+    target_basis, target_deltas = world_deltas(target_mesh)
+
+    nearest = nearest_vertices(source_basis, target_basis)
+    samples_source = source_deltas.reshape(len(source_deltas), -1).T
+    samples_target = target_deltas[:, nearest].reshape(len(target_deltas), -1).T
+
+    # target deltas are the unknown combination here, hence the transposes
+    return solve_conversion(samples_target, samples_source, regularization).T
+
+# ID property of the source shape keys holding the recorded pose pairs
+POSES_PROPERTY = "retarget_poses"
+
+# Pose pairs stored on the source shape keys by Blendshape_record_pose, as
+# (npose, ns) and (npose, nt) arrays in the current key order
+def pose_samples(source_mesh, target_mesh):
+    source_names = [sk.name for sk in source_mesh.data.shape_keys.key_blocks[1:]]
+    target_names = [sk.name for sk in target_mesh.data.shape_keys.key_blocks[1:]]
+    poses = source_mesh.data.shape_keys.get(POSES_PROPERTY, {})
+
+    source = numpy.zeros((len(poses), len(source_names)))
+    target = numpy.zeros((len(poses), len(target_names)))
+    for n, pose in enumerate(poses.values()):
+        source[n] = [pose['source'].get(name, 0.0) for name in source_names]
+        target[n] = [pose['target'].get(name, 0.0) for name in target_names]
+    return source, target
+
+# Stores a (target keys, source keys) matrix, basis excluded, as the conversion
+# values of the source mesh, the format Blendshape_retarget_single_blendshape
+# writes, so it is saved with the file and compiled by get_conversion
+def store_conversion(source_mesh, target_mesh, matrix):
+    source_keys = source_mesh.data.shape_keys
+    target_names = [sk.name for sk in target_mesh.data.shape_keys.key_blocks[1:]]
+
+    for i, sk in enumerate(source_keys.key_blocks[1:]):
+        source_keys[sk.name] = {name: float(matrix[j, i]) for j, name in enumerate(target_names)}
+    invalidate_conversions()
+
+# Bumped whenever conversion values are stored, so compiled matrices are rebuilt
+_conversion_version = 0
+# Compiled matrices by (source key, target key) datablock
+_conversion_cache = {}
+
+# Dense form of the conversion dictionaries stored on the source shape keys
+# matrix[j, i] is how much source key i contributes to target key j, so a
+# frame's retarget is one matrix-vector product. Targets are clamped to their
+# slider range, as setting key_block.value does.
+class ConversionMatrix:
+    def __init__(self, source_mesh, target_mesh):
+        source_keys = source_mesh.data.shape_keys
+        target_keys = target_mesh.data.shape_keys
+        source_blocks = source_keys.key_blocks
+        target_blocks = target_keys.key_blocks
+
+        self.version = _conversion_version
+        self.source_names = [sk.name for sk in source_blocks]
+        self.target_names = [sk.name for sk in target_blocks]
+
+        index = {name: j for j, name in enumerate(self.target_names)}
+        self.matrix = numpy.zeros((len(target_blocks), len(source_blocks)), dtype=numpy.float32)
+        for i, name in enumerate(self.source_names):
+            if name in source_keys:
+                for target_name, value in source_keys[name].items():
+                    j = index.get(target_name)
+                    if j is not None:
+                        self.matrix[j, i] = value
+
+        self.lower = numpy.array([sk.slider_min for sk in target_blocks], dtype=numpy.float32)
+        self.upper = numpy.array([sk.slider_max for sk in target_blocks], dtype=numpy.float32)
+        self.source_values = numpy.zeros(len(source_blocks), dtype=numpy.float32)
+        self.target_values = numpy.zeros(len(target_blocks), dtype=numpy.float32)
+
+    # still valid for these shape keys (same keys in the same order, no new
+    # conversion values); renaming or reordering keys changes the matrix too
+    def matches(self, source_blocks, target_blocks):
+        return (self.version == _conversion_version
+                and source_blocks.keys() == self.source_names
+                and target_blocks.keys() == self.target_names)
+
+def invalidate_conversions():
+    global _conversion_version
+    _conversion_version += 1
+
+# Compiled conversion matrix between the two meshes, rebuilt when keys are
+# added, removed, renamed or reordered or new conversion values were stored
+def get_conversion(source_mesh, target_mesh, rebuild=False):
+    source_keys = source_mesh.data.shape_keys
+    target_keys = target_mesh.data.shape_keys
+    cache_key = (source_keys.as_pointer(), target_keys.as_pointer())
+
+    conversion = _conversion_cache.get(cache_key)
+    if rebuild or conversion is None or not conversion.matches(source_keys.key_blocks, target_keys.key_blocks):
+        conversion = ConversionMatrix(source_mesh, target_mesh)
+        _conversion_cache[cache_key] = conversion
+    return conversion
+
+# Sets the target key values from the source key values in bulk
+def retarget(source_mesh, target_mesh, rebuild=False):
+    if source_mesh.data.shape_keys is None or target_mesh.data.shape_keys is None:
+        return
+
+    conversion = get_conversion(source_mesh, target_mesh, rebuild)
+    source_mesh.data.shape_keys.key_blocks.foreach_get('value', conversion.source_values)
+    numpy.matmul(conversion.matrix, conversion.source_values, out=conversion.target_values)
+    numpy.clip(conversion.target_values, conversion.lower, conversion.upper, out=conversion.target_values)
+
+    target_keys = target_mesh.data.shape_keys
+    target_keys.key_blocks.foreach_set('value', conversion.target_values)
+    target_keys.update_tag()
+    target_mesh.data.update_tag()
+
+def has_shape_keys(obj):
+    return obj is not None and obj.data.shape_keys is not None
 
 class Blendshape_retarget_manual(bpy.types.Operator):
-    """Tooltip"""
+    """Fits the conversion values of every shape key at once, from the stored pose pairs or from the key shapes"""
     bl_idname = "retarget.blendshapes_all"
-    bl_label = "Retarget each blendshape operator"
+    bl_label = "Solve All Conversion Values"
 
     def execute(self, context):
         fc = context.scene.fc_settings
         source_mesh = fc.blendshape_mesh
         target_mesh = fc.retarget_mesh
+        if not has_shape_keys(source_mesh) or not has_shape_keys(target_mesh):
+            self.report({'WARNING'}, "Both meshes need shape keys")
+            return {'CANCELLED'}
+
+        if fc.retarget_fit == 'POSES':
+            s, t = pose_samples(source_mesh, target_mesh)
+            if len(s) == 0:
+                self.report({'WARNING'}, "No pose pairs stored")
+                return {'CANCELLED'}
+            matrix, _ = calculate_shape_key_weights(t, s, simpified=False, regularization=fc.retarget_regularization)
+        else:
+            matrix = fit_conversion_geometry(source_mesh, target_mesh, fc.retarget_regularization)
+
+        store_conversion(source_mesh, target_mesh, matrix)
+        get_conversion(source_mesh, target_mesh)
+        return {'FINISHED'}
+
+class Blendshape_record_pose(bpy.types.Operator):
+    """Stores the current source and target shape key values as a pose pair for Solve All Conversion Values"""
+    bl_idname = "retarget.record_pose"
+    bl_label = "Add Pose Pair"
+
+    def execute(self, context):
+        fc = context.scene.fc_settings
+        if not has_shape_keys(fc.blendshape_mesh) or not has_shape_keys(fc.retarget_mesh):
+            self.report({'WARNING'}, "Both meshes need shape keys")
+            return {'CANCELLED'}
+        source_keys = fc.blendshape_mesh.data.shape_keys
+
+        poses = source_keys.get(POSES_PROPERTY)
+        if poses is None:
+            source_keys[POSES_PROPERTY] = {}
+            poses = source_keys[POSES_PROPERTY]
+        poses[str(len(poses))] = {
+            'source': {name: value for name, value in get_vals(fc.blendshape_mesh)[1:]},
+            'target': {name: value for name, value in get_vals(fc.retarget_mesh)[1:]},
+        }
+        self.report({'INFO'}, "{} pose pairs".format(len(poses)))
+
+        return {'FINISHED'}
+
+class Blendshape_clear_poses(bpy.types.Operator):
+    """Removes the stored pose pairs"""
+    bl_idname = "retarget.clear_poses"
+    bl_label = "Clear Pose Pairs"
 
-        s = get_vals (source_mesh)
-        t = get_vals (target_mesh)
+    def execute(self, context):
+        source_mesh = context.scene.fc_settings.blendshape_mesh
+        if not has_shape_keys(source_mesh):
+            self.report({'WARNING'}, "The blendshape mesh has no shape keys")
+            return {'CANCELLED'}
+        source_keys = source_mesh.data.shape_keys
+        if POSES_PROPERTY in source_keys:
+            del source_keys[POSES_PROPERTY]
 
-        calculate_shape_key_weights(s,t)
         return {'FINISHED'}
 
 class Blendshape_retarget_single_blendshape(bpy.types.Operator):
@@ -77,6 +286,7 @@ class Blendshape_retarget_single_blendshape(bpy.types.Operator):
         #load all values into the final refence structure, for source shape key, pairing with every target shape key r[0], we'll atribute their value r[1]
         for o in organized:
             source_mesh.data.shape_keys[target_sk][o[0]] = o[1]/divider
+        invalidate_conversions()
 
         return {'FINISHED'}
 
@@ -88,19 +298,27 @@ class Blendshape_target_update(bpy.types.Operator):
     def execute(self, context):
         #select the relevant blendshape information from the retarget and blendshape mesh
         fc = context.scene.fc_settings
-        t = fc.retarget_mesh.data.shape_keys.key_blocks
-        s = fc.blendshape_mesh.data.shape_keys.key_blocks
-        conversion = fc.blendshape_mesh.data.shape_keys
 
-        ###clear final blendshape values
-        for i in t:
-            i.value = 0
+        # recompiled here in case conversion values were edited by hand
+        retarget(fc.blendshape_mesh, fc.retarget_mesh, rebuild=True)
+
+        return {'FINISHED'}
+
+class Blendshape_bind_landmarks(bpy.types.Operator):
+    """Binds the target mesh to the landmark mesh triangles it lies on, with the current landmarks as rest pose"""
+    bl_idname = "retarget.bind_landmarks"
+    bl_label = "Bind to Landmarks"
+
+    @classmethod
+    def poll(cls, context):
+        fc = context.scene.fc_settings
+        return fc.landmark_mesh is not None and fc.retarget_mesh is not None
+
+    def execute(self, context):
+        fc = context.scene.fc_settings
 
-        for i in s:
-            if i.name in conversion: 
-                for j in t:
-                    if j.name in conversion[i.name]:
-                        j.value += i.value * conversion[i.name][j.name]
+        mapping = landmark_retarget.bind(fc.landmark_mesh, fc.retarget_mesh, fc.retarget_falloff)
+        self.report({'INFO'}, "Bound %d of %d vertices" % (len(mapping), len(fc.retarget_mesh.data.vertices)))
 
         return {'FINISHED'}
 
@@ -110,14 +328,20 @@ def menu_func(self, context):
 # Register and add to the "object" menu (required to also use F3 search "Simple Object Operator" for quick access)
 def register():
     bpy.utils.register_class(Blendshape_retarget_manual)
+    bpy.utils.register_class(Blendshape_record_pose)
+    bpy.utils.register_class(Blendshape_clear_poses)
     bpy.utils.register_class(Blendshape_retarget_single_blendshape)
     bpy.utils.register_class(Blendshape_target_update)
+    bpy.utils.register_class(Blendshape_bind_landmarks)
     bpy.types.VIEW3D_MT_object.append(menu_func)
 
 
 def unregister():
+    bpy.utils.unregister_class(Blendshape_bind_landmarks)
     bpy.utils.unregister_class(Blendshape_target_update)
     bpy.utils.unregister_class(Blendshape_retarget_single_blendshape)
+    bpy.utils.unregister_class(Blendshape_clear_poses)
+    bpy.utils.unregister_class(Blendshape_record_pose)
     bpy.utils.unregister_class(Blendshape_retarget_manual)
     bpy.types.VIEW3D_MT_object.remove(menu_func)
 
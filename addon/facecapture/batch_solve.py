@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Offline solve of video files to blendshape weights, without a camera or UI.
+#
+# Outside Blender, from the addon directory:
+#   python -m facecapture.batch_solve video.mp4 --keys keys.npy --output weights.npz
+# Inside Blender, keying the shape keys of an object in the open file:
+#   blender --background scene.blend --python-expr "from facecapture import batch_solve; batch_solve.main()" -- video.mp4 --object Face --save
+#
+# The main process only hands out frame ranges (chunks) to a pool of worker
+# processes. Each worker opens the video itself, seeks to its chunk and decodes
+# it, detects the landmarks with its own FaceMesh session, solves the metric
+# landmarks for the whole chunk at once and the weights with one matrix
+# product, so no pixels cross process boundaries. Chunks are collected in
+# submission order, so results come out in frame order.
+
+import argparse
+import collections
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .facegeometry import PCF, get_metric_landmarks_batch
+from .frame_source import EndOfStream, open_source
+from .landmark_buffer import NUM_LANDMARKS, NUM_FACE_LANDMARKS
+
+
+# Worker process state, set up once by _init_worker
+_source = None
+_session = None
+_buffer = None
+_pcf = None
+_mesh = None
+_flip = True
+
+
+def _init_worker(video_path, keys, frame_height, frame_width, flip):
+    global _source, _session, _buffer, _pcf, _mesh, _flip
+    from .mediapipe_capture import FaceMeshSession
+    from .landmark_buffer import LandmarkBuffer
+    from .Blendshape import BlendshapeMesh
+
+    _source = open_source(video_path, prefetch=0)
+    _session = FaceMeshSession()
+    _buffer = LandmarkBuffer(1)
+    # same camera model as capturePipeline: focal length = frame width
+    _pcf = PCF(near=1, far=10000, frame_height=frame_height, frame_width=frame_width, fy=frame_width)
+    _mesh = None if keys is None else BlendshapeMesh(keys)
+    _flip = flip
+
+
+# Solves frames [start, start + count), fewer at the end of the video
+def _solve_chunk(start, count):
+    # chunks of one worker are usually not adjacent: tracking from the frame
+    # before only carries over when this chunk continues the previous one
+    if _source.index != start:
+        _source.seek(start)
+        _session.reset()
+
+    images, timestamps = [], []
+    try:
+        for _ in range(count):
+            image, timestamp = _source.read()
+            images.append(image)
+            timestamps.append(timestamp)
+    except EndOfStream:
+        pass
+
+    n = len(images)
+    has_face = np.zeros(n, dtype=bool)
+    landmark = np.zeros((n, NUM_LANDMARKS, 3), dtype=np.float32)
+
+    for i, image in enumerate(images):
+        if _flip:
+            image = cv2.flip(image, 1)
+        results = _session.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if results.multi_face_landmarks:
+            points = _buffer.fill(0, results.multi_face_landmarks[0])
+            landmark[i, :len(points)] = points
+            has_face[i] = True
+
+    metric_landmarks = np.zeros((n, 3, NUM_FACE_LANDMARKS))
+    pose_transform_mat = np.tile(np.eye(4), (n, 1, 1))
+    if has_face.any():
+        screen = landmark[has_face, :NUM_FACE_LANDMARKS].transpose(0, 2, 1).astype(np.float64)
+        metric_landmarks[has_face], pose_transform_mat[has_face] = get_metric_landmarks_batch(screen, _pcf)
+
+    result = {
+        'timestamp': np.asarray(timestamps, dtype=np.float64),
+        'has_face': has_face,
+        'landmark': landmark,
+        'metric_landmarks': metric_landmarks,
+        'pose_transform_mat': pose_transform_mat,
+    }
+
+    if _mesh is not None:
+        nb = _mesh.dif.shape[0]
+        weights = np.zeros((n, nb))
+        error = np.zeros(n)
+        if has_face.any():
+            weights[has_face], error[has_face] = _mesh.get_weights_batch(metric_landmarks[has_face].transpose(0, 2, 1))
+        result['weights'] = weights
+        result['error'] = error
+
+    return result
+
+
+# Generator of per-chunk results in frame order
+# video_path: video file or image directory
+# keys: (nkeys + 1, 468, 3) basis and shape keys to solve weights for, or None
+# Every result holds 'timestamp', 'has_face', 'landmark', 'metric_landmarks',
+# 'pose_transform_mat' and, with keys, 'weights' and 'error', one row per frame
+def solve_video(video_path, keys=None, workers=None, chunk_size=32, flip=True, verbose=True):
+    # only probed for the frame size, every worker decodes its own chunks
+    source = open_source(video_path, prefetch=0)
+    frame_height, frame_width = source.frame_size
+    source.release()
+    workers = workers or os.cpu_count() or 1
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(video_path, keys, frame_height, frame_width, flip)
+    )
+
+    # at most two chunks in flight per worker; the frame count reported by
+    # containers is unreliable, so chunks are handed out until one comes
+    # back short
+    pending = collections.deque()
+    frames = 0
+    t0 = time.perf_counter()
+
+    def collect():
+        nonlocal frames
+        result = pending.popleft().result()
+        frames += len(result['timestamp'])
+        if verbose:
+            elapsed = time.perf_counter() - t0
+            print("{:8d} frames  {:10.1f} frames/s".format(frames, frames / elapsed), end='\r')
+        return result
+
+    try:
+        start = 0
+        ended = False
+        while not ended:
+            pending.append(executor.submit(_solve_chunk, start, chunk_size))
+            start += chunk_size
+            if len(pending) >= 2 * workers:
+                result = collect()
+                ended = len(result['timestamp']) < chunk_size
+                if len(result['timestamp']) > 0:
+                    yield result
+
+        # chunks submitted past the end come back empty
+        while pending:
+            result = collect()
+            if len(result['timestamp']) > 0:
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+    if verbose:
+        elapsed = time.perf_counter() - t0
+        print("\n{} frames in {:.2f}s, {:.1f} frames/s with {} workers".format(
+            frames, elapsed, frames / max(elapsed, 1e-9), workers))
+
+
+def _concatenate(results):
+    if len(results) == 0:
+        return {}
+    return {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+
+
+def _record(recorder, result):
+    for i in range(len(result['timestamp'])):
+        faces = []
+        if result['has_face'][i]:
+            faces.append({
+                'landmark': result['landmark'][i, :NUM_FACE_LANDMARKS],
+                'iris': result['landmark'][i, NUM_FACE_LANDMARKS:],
+                'metric_landmarks': result['metric_landmarks'][i],
+                'pose_transform_mat': result['pose_transform_mat'][i],
+            })
+        recorder.write(faces, False, result['timestamp'][i])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Solve blendshape weights for every frame of a video")
+    parser.add_argument('video', help="input video file or image directory")
+    parser.add_argument('--keys', help=".npy with the (nkeys + 1, 468, 3) basis and shape keys")
+    parser.add_argument('--object', help="Blender object whose shape keys are solved and keyed")
+    parser.add_argument('--output', help=".npz to write weights, landmarks and timestamps to")
+    parser.add_argument('--record', help="directory to write a landmark recording to, must not hold one already")
+    parser.add_argument('--save', action='store_true', help="save the .blend file after keying")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: cpu count)")
+    parser.add_argument('--chunk-size', type=int, default=32, help="frames sent to a worker at a time")
+    parser.add_argument('--no-flip', action='store_true', help="do not mirror frames as the live capture does")
+    parser.add_argument('--tolerance', type=float, default=0.0, help="keyframe reduction tolerance")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    args = parse_args(argv)
+
+    keys = None
+    obj = None
+    if args.object is not None:
+        import bpy
+        from .face_capture_modal import convertBlenderObj
+        obj = bpy.data.objects[args.object]
+        keys = convertBlenderObj(obj)
+    elif args.keys is not None:
+        keys = np.load(args.keys)
+
+    recorder = None
+    if args.record is not None:
+        from .landmark_recording import LandmarkRecorder
+        recorder = LandmarkRecorder(args.record)
+
+    keyframes = None
+    if obj is not None and keys.shape[0] > 1:
+        from .keyframe_recorder import KeyframeRecorder
+        keyframes = KeyframeRecorder(tolerance=args.tolerance)
+        scene = bpy.context.scene
+        scene_fps = scene.render.fps / scene.render.fps_base
+        names = [sk.name for sk in obj.data.shape_keys.key_blocks[1:]]
+
+    results = []
+    for result in solve_video(args.video, keys, args.workers, args.chunk_size, not args.no_flip):
+        if recorder is not None:
+            _record(recorder, result)
+        if keyframes is not None:
+            for timestamp, has_face, weights in zip(result['timestamp'], result['has_face'], result['weights']):
+                if has_face:
+                    keyframes.record(obj, scene.frame_start + timestamp * scene_fps, names, weights)
+        if args.output is not None:
+            results.append(result)
+
+    if recorder is not None:
+        recorder.close()
+    if keyframes is not None:
+        keyframes.flush()
+        print("{} keyframes written".format(keyframes.written))
+        if args.save:
+            bpy.ops.wm.save_mainfile()
+    if args.output is not None:
+        np.savez(args.output, **_concatenate(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,750 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the capture and solve hot paths.
+#
+# Run from the addon directory, outside Blender:
+#   python -m facecapture.benchmark <name> [args...]
+# Benchmarks that need bpy run inside Blender with the addon installed:
+#   blender --background --python-expr "from facecapture import benchmark; benchmark.main()" -- <name> [args...]
+
+import sys
+import time
+
+import numpy as np
+
+
+def report(label, durations):
+    durations = np.asarray(durations) * 1000.0
+    print("{:40s} mean {:10.4f}ms  p50 {:10.4f}ms  p95 {:10.4f}ms  ({} runs)".format(
+        label,
+        np.mean(durations),
+        np.percentile(durations, 50),
+        np.percentile(durations, 95),
+        len(durations)))
+
+
+def timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+
+def read_video(video_path, max_frames):
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        success, image = cap.read()
+        if not success:
+            break
+        frames.append(cv2.cvtColor(cv2.flip(image, 1), cv2.COLOR_BGR2RGB))
+    cap.release()
+
+    if len(frames) == 0:
+        raise RuntimeError("No frames read from " + video_path)
+    return frames
+
+
+# Per-frame latency of a FaceMesh graph built on every frame (old capture path)
+# against one persistent FaceMeshSession
+def bench_session(video_path, max_frames=300):
+    import mediapipe as mp
+    from .mediapipe_capture import FaceMeshSession
+
+    frames = read_video(video_path, int(max_frames))
+
+    def per_frame(image):
+        with mp.solutions.face_mesh.FaceMesh(
+            refine_landmarks=True,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        ) as face_mesh:
+            face_mesh.process(image)
+
+    old = []
+    for image in frames:
+        old += timed(lambda: per_frame(image), 1)
+
+    new = []
+    with FaceMeshSession() as session:
+        for image in frames:
+            new += timed(lambda: session.process(image), 1)
+
+    report("FaceMesh per frame", old)
+    report("FaceMeshSession", new)
+
+
+# Landmark extraction from a NormalizedLandmarkList: list comprehension used
+# by the old getRigidInfo against the bulk copy into a LandmarkBuffer
+def bench_landmarks(repeat=2000):
+    from mediapipe.framework.formats import landmark_pb2
+    from .landmark_buffer import LandmarkBuffer, NUM_LANDMARKS
+
+    rng = np.random.default_rng(0)
+    landmark_list = landmark_pb2.NormalizedLandmarkList()
+    for x, y, z in rng.random((NUM_LANDMARKS, 3)):
+        lm = landmark_list.landmark.add()
+        lm.x, lm.y, lm.z = x, y, z
+
+    buffer = LandmarkBuffer()
+    expected = np.array([(lm.x, lm.y, lm.z) for lm in landmark_list.landmark], dtype=np.float32)
+    assert np.array_equal(buffer.fill(0, landmark_list), expected)
+
+    def comprehension():
+        np.array([(lm.x, lm.y, lm.z) for lm in landmark_list.landmark[:468]]).T
+
+    report("list comprehension", timed(comprehension, int(repeat)))
+    report("LandmarkBuffer.fill", timed(lambda: buffer.fill(0, landmark_list), int(repeat)))
+
+
+# Screen-space landmarks of the canonical face seen by a 640x480 camera,
+# under a random head pose with some per-landmark noise
+def synthetic_screen_landmarks(rng, pcf, noise=0.05):
+    from .facegeometry import canonical_metric_landmarks
+
+    angles = rng.uniform(-0.3, 0.3, 3)
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rotation = (np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]]) @
+                np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) @
+                np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]))
+
+    points = rotation @ canonical_metric_landmarks
+    points = points + rng.normal(0, noise, points.shape)
+    points = points + np.array([[rng.uniform(-5, 5)], [rng.uniform(-5, 5)], [-rng.uniform(40, 60)]])
+
+    x = points[0] * pcf.near / -points[2]
+    y = points[1] * pcf.near / -points[2]
+    width = pcf.right - pcf.left
+    height = pcf.top - pcf.bottom
+
+    return np.array([
+        (x - pcf.left) / width,
+        1.0 - (y - pcf.bottom) / height,
+        (points[2] - np.mean(points[2])) * pcf.near / -np.mean(points[2]) / width,
+    ])
+
+
+def capture_pcf():
+    from .facegeometry import PCF
+    return PCF(near=1, far=10000, frame_height=480, frame_width=640, fy=640)
+
+
+# Pose solve using all 468 landmark columns against the sparse solver with
+# the canonical sources precomputed at import; checks both give the same result
+def bench_sparse_solver(repeat=2000):
+    from . import facegeometry
+
+    rng = np.random.default_rng(0)
+    pcf = capture_pcf()
+    frames = [synthetic_screen_landmarks(rng, pcf) for _ in range(64)]
+
+    def solve_all(sparse):
+        facegeometry.use_sparse_solver(sparse)
+        return [facegeometry.get_metric_landmarks(f.copy(), pcf) for f in frames]
+
+    for (dense_lms, dense_pose), (sparse_lms, sparse_pose) in zip(solve_all(False), solve_all(True)):
+        assert np.allclose(dense_lms, sparse_lms, rtol=1e-10, atol=1e-10)
+        assert np.allclose(dense_pose, sparse_pose, rtol=1e-10, atol=1e-10)
+
+    target = frames[0]
+    for sparse in (False, True):
+        facegeometry.use_sparse_solver(sparse)
+        label = "sparse" if sparse else "dense"
+        report("solve_canonical " + label, timed(lambda: facegeometry.solve_canonical(target), int(repeat)))
+        report("get_metric_landmarks " + label, timed(lambda: facegeometry.get_metric_landmarks(target.copy(), pcf), int(repeat)))
+
+
+# Per-frame cost of the solver debug hooks: no tracer attached against a
+# tracer whose hooks do nothing, which is what every frame used to pay
+# through log() and cpp_compare() with debugging off
+def bench_tracer(repeat=2000):
+    from . import facegeometry
+
+    class NullTracer:
+        def log(self, name, f):
+            pass
+
+        def compare(self, name, np_matrix):
+            pass
+
+    rng = np.random.default_rng(0)
+    pcf = capture_pcf()
+    target = synthetic_screen_landmarks(rng, pcf)
+
+    for sparse in (False, True):
+        facegeometry.use_sparse_solver(sparse)
+        label = "sparse" if sparse else "dense"
+        facegeometry.set_tracer(NullTracer())
+        report("get_metric_landmarks hooks " + label, timed(lambda: facegeometry.get_metric_landmarks(target.copy(), pcf), int(repeat)))
+        facegeometry.set_tracer(None)
+        report("get_metric_landmarks no tracer " + label, timed(lambda: facegeometry.get_metric_landmarks(target.copy(), pcf), int(repeat)))
+
+
+# Metric landmarks for N frames: one get_metric_landmarks call per frame
+# against a single get_metric_landmarks_batch call on the (N, 3, 468) stack
+def bench_batch(max_frames=1024, repeat=5):
+    from . import facegeometry
+
+    rng = np.random.default_rng(0)
+    pcf = capture_pcf()
+    frames = np.stack([synthetic_screen_landmarks(rng, pcf) for _ in range(int(max_frames))])
+
+    batch_lms, batch_pose = facegeometry.get_metric_landmarks_batch(frames.copy(), pcf)
+    for frame, lms, pose in zip(frames, batch_lms, batch_pose):
+        single_lms, single_pose = facegeometry.get_metric_landmarks(frame.copy(), pcf)
+        assert np.allclose(single_lms, lms, rtol=1e-9, atol=1e-9)
+        assert np.allclose(single_pose, pose, rtol=1e-9, atol=1e-9)
+
+    n = 1
+    while n <= len(frames):
+        stack = frames[:n]
+        single = timed(lambda: [facegeometry.get_metric_landmarks(f.copy(), pcf) for f in stack], int(repeat))
+        batch = timed(lambda: facegeometry.get_metric_landmarks_batch(stack.copy(), pcf), int(repeat))
+        print("N = {:5d}  per frame {:10.1f} fps  batch {:10.1f} fps".format(
+            n, n / np.median(single), n / np.median(batch)))
+        n *= 4
+
+
+# Per-frame weight solve: np.linalg.lstsq on the key delta matrix (old
+# get_weights) against BlendshapeMesh with its cached pseudo-inverse
+def bench_blendshape_solve(repeat=200, nverts=468):
+    from .Blendshape import BlendshapeMesh
+
+    rng = np.random.default_rng(0)
+    nverts = int(nverts)
+    for nb in (5, 10, 25, 50, 100, 200):
+        data = rng.normal(size=(nb + 1, nverts, 3))
+        mesh = BlendshapeMesh(data)
+        landmarks = mesh.vertices(rng.random(nb)) + rng.normal(0, 0.01, (nverts, 3))
+
+        A = mesh.dif.transpose(1, 2, 0).reshape(-1, nb)
+        B = (landmarks - mesh.basis).reshape(-1, 1)
+        x, residuals, rank, s = np.linalg.lstsq(A, B, rcond=None)
+        weights, error = mesh.get_weights(landmarks)
+        assert np.allclose(x[:, 0], weights) and np.isclose(residuals[0], error)
+
+        old = timed(lambda: np.linalg.lstsq(A, (landmarks - mesh.basis).reshape(-1, 1), rcond=None), int(repeat))
+        new = timed(lambda: mesh.get_weights(landmarks), int(repeat))
+        report("nb = {:3d} lstsq".format(nb), old)
+        report("nb = {:3d} cached pinv".format(nb), new)
+
+
+# Bounded solver on a slowly changing expression with correlated keys:
+# warm-started active set against a fresh lstsq per frame
+def bench_bounded_solve(repeat=100, nverts=468):
+    from .Blendshape import BlendshapeMesh
+
+    rng = np.random.default_rng(0)
+    nverts = int(nverts)
+    for nb in (10, 50, 100, 200):
+        basis_shapes = rng.normal(size=(10, nverts, 3))
+        keys = np.tensordot(rng.random((nb, 10)), basis_shapes, axes=(1, 0)) + rng.normal(0, 0.05, (nb, nverts, 3))
+        mesh = BlendshapeMesh(np.concatenate([np.zeros((1, nverts, 3)), keys]))
+
+        weights = np.clip(rng.normal(0.3, 0.3, nb), 0, 1)
+        frames = []
+        for _ in range(int(repeat)):
+            weights = np.clip(weights + rng.normal(0, 0.02, nb), 0, 1)
+            frames.append(mesh.vertices(weights) + rng.normal(0, 0.01, (nverts, 3)))
+
+        A = mesh.dif.transpose(1, 2, 0).reshape(-1, nb)
+        old = [timed(lambda: np.linalg.lstsq(A, (f - mesh.basis).reshape(-1, 1), rcond=None), 1)[0] for f in frames]
+        new = [timed(lambda: mesh.get_weights_bounded(f), 1)[0] for f in frames]
+        report("nb = {:3d} lstsq".format(nb), old)
+        report("nb = {:3d} bounded warm start".format(nb), new)
+
+
+# Shape key extraction on grid meshes from 468 to 50k vertices: per-vertex
+# loop of the old convertBlenderObj against the foreach_get version
+# Needs Blender (see header)
+def bench_convert(nkeys=10, repeat=3):
+    import bpy
+    from .face_capture_modal import convertBlenderObj
+
+    def convert_loop(obj):
+        list = []
+        kbs = obj.data.shape_keys.key_blocks
+        base_verts = kbs[0].data
+        for sk in kbs:
+            group_name = sk.vertex_group
+            verts = []
+            for i, vert in enumerate(sk.data):
+                a = base_verts[i].co
+                b = vert.co
+                if group_name == '':
+                    verts.append(b)
+                else:
+                    try:
+                        w = obj.vertex_groups[group_name].weight(i)
+                    except:
+                        w = 0
+                    verts.append(a + w*(b-a))
+            list.append(verts)
+        return np.array(list)
+
+    rng = np.random.default_rng(0)
+    for side in (22, 50, 100, 224):
+        nverts = side * side
+        mesh = bpy.data.meshes.new("bench")
+        xs, ys = np.meshgrid(np.arange(side), np.arange(side))
+        co = np.stack([xs.ravel(), ys.ravel(), np.zeros(nverts)], axis=1).astype(np.float32)
+        mesh.vertices.add(nverts)
+        mesh.vertices.foreach_set('co', co.ravel())
+        obj = bpy.data.objects.new("bench", mesh)
+        bpy.context.collection.objects.link(obj)
+
+        group = obj.vertex_groups.new(name="half")
+        group.add(list(range(nverts // 2)), 0.5, 'REPLACE')
+
+        obj.shape_key_add(name="Basis", from_mix=False)
+        for k in range(int(nkeys)):
+            sk = obj.shape_key_add(name="key_{}".format(k), from_mix=False)
+            sk.data.foreach_set('co', (co + rng.normal(0, 0.1, co.shape).astype(np.float32)).ravel())
+            if k % 2 == 0:
+                sk.vertex_group = group.name
+
+        assert np.allclose(convert_loop(obj), convertBlenderObj(obj), atol=1e-5)
+        report("{:6d} verts per-vertex loop".format(nverts), timed(lambda: convert_loop(obj), int(repeat)))
+        report("{:6d} verts foreach_get".format(nverts), timed(lambda: convertBlenderObj(obj), int(repeat)))
+
+        bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(mesh)
+
+
+# Cost of adding one key as the library grows: rebuilding BlendshapeMesh
+# from every key against append_key on the existing one
+def bench_append_key(max_keys=300, nverts=468):
+    from .Blendshape import BlendshapeMesh
+
+    rng = np.random.default_rng(0)
+    nverts = int(nverts)
+    data = rng.normal(size=(int(max_keys) + 1, nverts, 3))
+    mesh = BlendshapeMesh(data[:1])
+
+    for nb in range(1, int(max_keys) + 1):
+        t0 = time.perf_counter()
+        mesh.append_key(data[nb])
+        t1 = time.perf_counter()
+
+        if nb in (10, 50, 100, 200, 300):
+            rebuild = timed(lambda: BlendshapeMesh(data[:nb + 1]), 3)
+            print("nb = {:3d}  rebuild {:10.4f}ms  append_key {:10.4f}ms".format(
+                nb, 1000 * np.median(rebuild), 1000 * (t1 - t0)))
+
+    full = BlendshapeMesh(data)
+    assert np.allclose(full._pinv[:int(max_keys)], mesh._pinv[:int(max_keys)], atol=1e-10)
+
+
+# Keying a recorded take: keyframe_insert per key per frame against the
+# buffered recorder flushing each fcurve in bulk
+def bench_keyframes(frames=1000, nkeys=20, tolerance=0.001):
+    import bpy
+    from .keyframe_recorder import KeyframeRecorder
+
+    frames, nkeys = int(frames), int(nkeys)
+    rng = np.random.default_rng(0)
+    weights = np.clip(np.cumsum(rng.normal(0, 0.02, (frames, nkeys)), axis=0), 0, 1)
+
+    mesh = bpy.data.meshes.new("bench")
+    mesh.vertices.add(468)
+    obj = bpy.data.objects.new("bench", mesh)
+    bpy.context.collection.objects.link(obj)
+    obj.shape_key_add(name="Basis", from_mix=False)
+    names = [obj.shape_key_add(name="key_{}".format(k), from_mix=False).name for k in range(nkeys)]
+    kbs = obj.data.shape_keys.key_blocks
+
+    def insert_loop():
+        for f in range(frames):
+            for k, name in enumerate(names):
+                kbs[name].value = weights[f, k]
+                kbs[name].keyframe_insert('value', frame=f)
+
+    def recorder(tol):
+        recorder = KeyframeRecorder(tolerance=tol)
+        for f in range(frames):
+            recorder.record(obj, float(f), names, weights[f])
+        recorder.flush()
+        return recorder
+
+    def clear():
+        obj.data.shape_keys.animation_data_clear()
+
+    report("keyframe_insert", timed(insert_loop, 1))
+    clear()
+    report("recorder", timed(lambda: recorder(0.0), 1))
+    clear()
+    result = []
+    report("recorder tolerance {}".format(tolerance), timed(lambda: result.append(recorder(float(tolerance))), 1))
+    print("{} points recorded, {} written".format(result[0].recorded * nkeys, result[0].written))
+
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(mesh)
+
+
+# Re-solves a landmark recording without a camera: replay at maximum speed
+# into a library built from every step-th recorded frame
+def bench_replay(recording_path, step=50):
+    from .Blendshape import BlendshapeMesh
+    from .landmark_recording import LandmarkRecording, ReplayCapture
+
+    recording = LandmarkRecording(recording_path)
+    keys = [record['metric_landmarks'].T for record in recording if record['has_face']][::int(step)]
+    if len(keys) == 0:
+        print("recording has no faces")
+        return
+    mesh = BlendshapeMesh(np.stack(keys))
+
+    replay = ReplayCapture(recording_path, realtime=False)
+    capture, solve = [], []
+    while not replay.finished:
+        t0 = time.perf_counter()
+        faces, close = replay.capture()
+        t1 = time.perf_counter()
+        if len(faces) > 0:
+            mesh.get_weights(faces[0]['metric_landmarks'].T)
+        t2 = time.perf_counter()
+        capture.append(t1 - t0)
+        solve.append(t2 - t1)
+
+    report("replay capture()", capture)
+    report("get_weights ({} keys)".format(len(keys) - 1), solve)
+    print("{:10.1f} frames/s".format(len(capture) / (sum(capture) + sum(solve))))
+
+
+# Frame sources without a camera: decode followed by a simulated inference
+# step of inference_ms, sequential against decode-ahead prefetching, then
+# the full synchronous capture pipeline over the same file
+def bench_source(path, max_frames=300, inference_ms=10):
+    from .frame_source import EndOfStream, open_source
+    from .mediapipe_capture import asyncCapture
+
+    max_frames, delay = int(max_frames), float(inference_ms) / 1000.0
+
+    def run(prefetch):
+        source = open_source(path, prefetch=prefetch)
+        durations = []
+        try:
+            for _ in range(max_frames):
+                t0 = time.perf_counter()
+                source.read()
+                time.sleep(delay)
+                durations.append(time.perf_counter() - t0)
+        except EndOfStream:
+            pass
+        source.release()
+        return source, durations
+
+    source, sequential = run(0)
+    print("{}x{} frames at {:.2f} fps".format(source.frame_width, source.frame_height, source.fps))
+    report("decode + inference", sequential)
+    report("prefetch + inference", run(8)[1])
+
+    capture, release = asyncCapture(path)
+    durations = []
+    try:
+        for _ in range(max_frames):
+            durations += timed(capture, 1)
+    except EndOfStream:
+        pass
+    release()
+    report("asyncCapture", durations)
+
+
+# Preprocessing and FaceMesh inference per frame at 720p and 1080p: the old
+# full frame flip + two conversions, the full frame with one conversion, a
+# face region a third of the frame high, and that region downscaled to 192.
+# Synthetic frames measure cost only; pass a video with a face to also run
+# the capture pipeline with and without region tracking.
+def bench_roi(video_path=None, repeat=50):
+    import cv2
+    from .face_roi import FaceROI
+    from .mediapipe_capture import FaceMeshSession, capturePipeline
+    from .frame_source import EndOfStream
+
+    repeat = int(repeat)
+    rng = np.random.default_rng(0)
+
+    for frame_height, frame_width in ((720, 1280), (1080, 1920)):
+        image = rng.integers(0, 255, (frame_height, frame_width, 3), dtype=np.uint8)
+        roi = FaceROI(frame_height, frame_width)
+        size = frame_height // 3
+        face = np.array([[0.5 - size / frame_width / 2, 0.5, 0], [0.5 + size / frame_width / 2, 0.5 + size / frame_height, 0]])
+
+        with FaceMeshSession() as session:
+            def old():
+                rgb = cv2.cvtColor(cv2.flip(image, 1), cv2.COLOR_BGR2RGB)
+                session.process(rgb)
+                cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+            def cropped(max_size):
+                session.process(roi.crop(image, max_size))
+
+            label = "{}p".format(frame_height)
+            report(label + " flip + RGB + BGR", timed(old, repeat))
+            roi.reset()
+            report(label + " full frame", timed(lambda: cropped(0), repeat))
+            roi.update(face / 1.6)
+            report(label + " region {}px".format(roi.box[2]), timed(lambda: cropped(0), repeat))
+            report(label + " region at 192px", timed(lambda: cropped(192), repeat))
+
+    if video_path is None:
+        return
+
+    for roi_tracking in (False, True):
+        read, process, release = capturePipeline(video_path, roi=roi_tracking, inference_size=192 if roi_tracking else 0)
+        durations, found = [], 0
+        try:
+            while True:
+                image, timestamp = read()
+                t0 = time.perf_counter()
+                faces, close = process(image)
+                durations.append(time.perf_counter() - t0)
+                found += len(faces) > 0
+        except EndOfStream:
+            pass
+        release()
+        report("pipeline roi={} ({} faces)".format(roi_tracking, found), durations)
+
+
+# Latency the preview adds to process(): mirroring and drawing the frame
+# inline (what the capture path did before, without imshow) against handing
+# it to the PreviewWindow thread
+def bench_preview(repeat=500, frame_height=720, frame_width=1280):
+    import cv2
+    from .mediapipe_capture import draw_face
+    from .preview import PreviewWindow
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (int(frame_height), int(frame_width), 3), dtype=np.uint8)
+    points = [rng.uniform(0.3, 0.7, (478, 3)).astype(np.float32)]
+
+    def inline():
+        mirrored = cv2.flip(image, 1)
+        for face_points in points:
+            draw_face(mirrored, face_points)
+
+    report("inline draw", timed(inline, int(repeat)))
+
+    # hidden, so this measures submit() alone without HighGUI
+    preview = PreviewWindow(draw_face)
+    report("PreviewWindow.submit", timed(lambda: preview.submit(image, points), int(repeat)))
+    preview.stop()
+
+
+# Overhead of a profiling span with profiling off, on, and on with tracing
+def bench_profiling(repeat=100000):
+    from . import profiling
+
+    def spans():
+        for _ in range(int(repeat)):
+            with profiling.span('bench'):
+                pass
+
+    profiling.disable()
+    off = timed(spans, 1)[0]
+    profiling.enable()
+    on = timed(spans, 1)[0]
+    profiling.enable(trace=True)
+    traced = timed(spans, 1)[0]
+    profiling.disable()
+
+    for label, total in (("off", off), ("on", on), ("on + trace", traced)):
+        print("span {:12s} {:10.3f}us".format(label, 1e6 * total / int(repeat)))
+
+
+# Retargeting one frame: the nested loop over ID-property dictionaries that
+# Blendshape_target_update ran against the compiled conversion matrix
+def bench_retarget(source_keys=50, target_keys=52, repeat=50):
+    import bpy
+    from .Blendshape_retarget_manual import retarget
+
+    rng = np.random.default_rng(0)
+
+    def make(name, nkeys):
+        mesh = bpy.data.meshes.new(name)
+        mesh.vertices.add(468)
+        obj = bpy.data.objects.new(name, mesh)
+        bpy.context.collection.objects.link(obj)
+        obj.shape_key_add(name="Basis", from_mix=False)
+        for k in range(int(nkeys)):
+            obj.shape_key_add(name="{}_{}".format(name, k), from_mix=False)
+        return obj
+
+    source, target = make("source", source_keys), make("target", target_keys)
+    conversion = source.data.shape_keys
+    t = target.data.shape_keys.key_blocks
+    s = source.data.shape_keys.key_blocks
+    for sk in s[1:]:
+        conversion[sk.name] = {tk.name: float(rng.uniform(0, 0.1)) for tk in t[1:]}
+        sk.value = float(rng.uniform(0, 1))
+
+    def nested_loop():
+        for i in t:
+            i.value = 0
+        for i in s:
+            if i.name in conversion:
+                for j in t:
+                    if j.name in conversion[i.name]:
+                        j.value += i.value * conversion[i.name][j.name]
+
+    report("ID-property nested loop", timed(nested_loop, int(repeat)))
+    report("compile + matvec", timed(lambda: retarget(source, target, rebuild=True), int(repeat)))
+    report("cached matvec", timed(lambda: retarget(source, target), int(repeat)))
+
+    for obj in (source, target):
+        mesh = obj.data
+        bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(mesh)
+
+
+# Landmark triangle binding of a target face with vertices scattered over the
+# canonical face, and the per frame deformation as a sparse gather against
+# the same mapping as a dense (3 * vertices, 1404) matrix
+def bench_landmark_retarget(vertices=5000, radius=1.0, repeat=200):
+    from .facegeometry import canonical_metric_landmarks
+    from .landmark_retarget import LandmarkMapping, TRIANGLES
+
+    rng = np.random.default_rng(0)
+    rest = canonical_metric_landmarks.T
+    triangles = rest[TRIANGLES[rng.integers(0, len(TRIANGLES), int(vertices))]]
+    points = np.einsum('nk,nkj->nj', rng.dirichlet((1, 1, 1), int(vertices)), triangles)
+    points += rng.normal(0, 0.2, points.shape)
+
+    start = time.perf_counter()
+    mapping = LandmarkMapping(rest, points, radius=float(radius))
+    print("bind {:.1f} ms, {} of {} vertices bound".format((time.perf_counter() - start) * 1e3, len(mapping), int(vertices)))
+
+    dense = np.zeros((len(points), 3, 468, 3), dtype=np.float32)
+    for k in range(3):
+        dense[mapping.vertex_index, :, mapping.landmark_index[:, k], :] += mapping.weights[:, k, None, None] * np.identity(3, dtype=np.float32)
+    dense = dense.reshape(3 * len(points), -1)
+    rest_vertices = mapping.rest_vertices.ravel()
+
+    landmarks = (rest + rng.normal(0, 0.1, rest.shape)).astype(np.float32)
+    delta = (landmarks - mapping.rest_landmarks).ravel()
+    assert np.allclose(rest_vertices + dense @ delta, mapping.deform(landmarks).ravel(), atol=1e-4)
+
+    report("dense matvec", timed(lambda: rest_vertices + dense @ (landmarks - mapping.rest_landmarks).ravel(), int(repeat)))
+    report("sparse deform", timed(lambda: mapping.deform(landmarks), int(repeat)))
+
+
+# Metric landmarks solved and written to a 468 vertex mesh, the old np.matrix
+# path against get_metric_landmarks(out=) and MeshWriter, with the peak of the
+# bytes allocated per call measured by tracemalloc
+def bench_mesh_writer(frames=200):
+    import tracemalloc
+    import bpy
+    from . import facegeometry
+    from .mesh_writer import MeshWriter
+
+    rng = np.random.default_rng(0)
+    pcf = capture_pcf()
+    screen = [synthetic_screen_landmarks(rng, pcf) for _ in range(int(frames))]
+    metric = [facegeometry.get_metric_landmarks(s.copy(), pcf)[0] for s in screen]
+
+    mesh = bpy.data.meshes.new("mesh_writer")
+    mesh.vertices.add(468)
+    writer = MeshWriter()
+
+    def matrix_write(metric_landmarks):
+        lms = np.matrix(metric_landmarks.T)
+        mesh.vertices.foreach_set('co', lms.A1)
+        mesh.update()
+
+    def measure(label, function, inputs):
+        function(inputs[0])
+        tracemalloc.start()
+        allocated = []
+        for x in inputs:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(x)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+        report(label, timed(lambda: function(inputs[0]), len(inputs)))
+        print("{:40s} {:9.0f} bytes allocated per call".format("", np.mean(allocated)))
+
+    measure("get_metric_landmarks", lambda s: facegeometry.get_metric_landmarks(s.copy(), pcf), screen)
+    measure("get_metric_landmarks out=", lambda s: facegeometry.get_metric_landmarks(s.copy(), pcf, writer.buffer), screen)
+    measure("np.matrix + foreach_set + update()", matrix_write, metric)
+    measure("MeshWriter.write", lambda m: writer.write(mesh, {'metric_landmarks': m}), metric)
+    shared = {'metric_landmarks': writer.buffer.T}
+    measure("MeshWriter.write shared buffer", lambda m: writer.write(mesh, shared), metric)
+
+    bpy.data.meshes.remove(mesh)
+
+
+# Landmark filters on (468, 3) landmarks moving along a 0.5 Hz sine with
+# gaussian jitter at 30 fps: time per frame, remaining jitter (rms error
+# against the clean motion) and lag in frames of the best aligned output
+def bench_temporal_filter(frames=300, noise=0.05, repeat=1000):
+    from .temporal_filter import OneEuroFilter, KalmanFilter
+
+    rng = np.random.default_rng(0)
+    t = np.arange(int(frames)) / 30.0
+    clean = np.sin(np.pi * t)[:, None, None] + np.zeros((1, 468, 3))
+    noisy = clean + rng.normal(0, noise, clean.shape)
+    print("{:40s} rms error {:.4f}".format("unfiltered", np.sqrt(np.mean((noisy - clean) ** 2))))
+
+    filters = (
+        ("One Euro min_cutoff=1 beta=0.1", lambda: OneEuroFilter(1.0, 0.1)),
+        ("One Euro min_cutoff=1 beta=2", lambda: OneEuroFilter(1.0, 2.0)),
+        ("Kalman q=10 r=0.0025", lambda: KalmanFilter(10.0, noise ** 2)),
+        ("Kalman q=1 r=0.0025", lambda: KalmanFilter(1.0, noise ** 2)),
+    )
+    for label, make in filters:
+        f = make()
+        out = np.array([f.filter(x, ts).copy() for x, ts in zip(noisy, t)])
+        settled = slice(30, None)
+        error = np.sqrt(np.mean((out[settled] - clean[settled]) ** 2))
+        lag = int(np.argmin([np.mean((out[30 + k:, 0, 0] - clean[30:len(t) - k, 0, 0]) ** 2) for k in range(15)]))
+
+        f = make()
+        buffer = np.zeros((468, 3), dtype=np.float32)
+        frame = iter(range(int(repeat)))
+        report(label, timed(lambda: f.filter(buffer, next(frame) / 30.0, out=buffer), int(repeat)))
+        print("{:40s} rms error {:.4f}, lag {} frames".format("", error, lag))
+
+
+BENCHMARKS = {
+    'session': bench_session,
+    'landmarks': bench_landmarks,
+    'sparse_solver': bench_sparse_solver,
+    'tracer': bench_tracer,
+    'batch': bench_batch,
+    'blendshape_solve': bench_blendshape_solve,
+    'bounded_solve': bench_bounded_solve,
+    'convert': bench_convert,
+    'append_key': bench_append_key,
+    'keyframes': bench_keyframes,
+    'replay': bench_replay,
+    'source': bench_source,
+    'roi': bench_roi,
+    'preview': bench_preview,
+    'profiling': bench_profiling,
+    'retarget': bench_retarget,
+    'landmark_retarget': bench_landmark_retarget,
+    'mesh_writer': bench_mesh_writer,
+    'temporal_filter': bench_temporal_filter,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+
+    if len(argv) < 1 or argv[0] not in BENCHMARKS:
+        print("usage: python -m facecapture.benchmark {" + ",".join(BENCHMARKS) + "} [args...]")
+        sys.exit(1)
+
+    BENCHMARKS[argv[0]](*argv[1:])
+
+
+if __name__ == '__main__':
+    main()
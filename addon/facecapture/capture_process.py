@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# One landmark frame as laid out in shared memory
+# 'seq' is set to -1 first and written last, so a reader that sees the same
+# seq before and after copying the slot knows the copy is not torn
+FRAME_DTYPE = np.dtype([
+    ('seq', np.int64),
+    ('timestamp', np.float64),
+    ('has_face', np.int32),
+    ('close', np.int32),
+    ('landmark', np.float32, (468, 3)),
+    ('iris', np.float32, (10, 3)),
+    ('metric_landmarks', np.float64, (3, 468)),
+    ('pose_transform_mat', np.float64, (4, 4)),
+], align=True)
+
+# Control words shared by both processes
+HEADER_DTYPE = np.dtype([
+    ('write_seq', np.int64),
+    ('show_cam', np.int64),
+    ('stop', np.int64),
+], align=True)
+HEADER_SIZE = 64
+
+
+# Fixed-size ring of landmark frames in a shared memory block
+# The worker process writes frames in place, so nothing is pickled per frame.
+# The reader copies the newest slot into a record of its own and drops the
+# copy when the writer touched the slot meanwhile (a seqlock), so a frame
+# handed to Blender never mixes several frames.
+class SharedLandmarkRing:
+    def __init__(self, buffer, nslots):
+        self.nslots = nslots
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+        self.slots = np.ndarray((nslots,), dtype=FRAME_DTYPE, buffer=buffer, offset=HEADER_SIZE)
+        self.last_seq = 0
+
+    @staticmethod
+    def size(nslots):
+        return HEADER_SIZE + nslots * FRAME_DTYPE.itemsize
+
+    def reset(self):
+        self.header['write_seq'] = 0
+        self.header['show_cam'] = 0
+        self.header['stop'] = 0
+        self.slots['seq'] = 0
+        self.last_seq = 0
+
+    # Writer side
+
+    def write(self, faces, close, timestamp):
+        seq = int(self.header['write_seq']) + 1
+        slot = self.slots[seq % self.nslots]
+
+        slot['seq'] = -1
+        slot['timestamp'] = timestamp
+        slot['close'] = close
+        slot['has_face'] = len(faces) > 0
+        if len(faces) > 0:
+            face = faces[0]
+            slot['landmark'] = face['landmark']
+            slot['iris'] = face['iris']
+            slot['metric_landmarks'] = face['metric_landmarks']
+            slot['pose_transform_mat'] = face['pose_transform_mat']
+        slot['seq'] = seq
+
+        self.header['write_seq'] = seq
+
+    # Reader side
+
+    # returns a copy of the newest unread slot or None
+    def read_latest(self):
+        seq = int(self.header['write_seq'])
+        if seq == self.last_seq:
+            return None
+
+        slot = self.slots[seq % self.nslots]
+        if slot['seq'] != seq:
+            # overwritten before we got to it, try again next tick
+            return None
+
+        frame = np.empty((), dtype=FRAME_DTYPE)
+        frame[...] = slot
+        if slot['seq'] != seq:
+            # overwritten while copying, the copy may be torn
+            return None
+
+        self.last_seq = seq
+        return frame
+
+    def release(self):
+        self.header = None
+        self.slots = None
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # the parent owns the block, keep the child's resource tracker
+        # from unlinking it when the worker exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def _worker_main(shm_name, nslots, source, realtime, roi, inference_size, max_num_faces):
+    from facecapture.mediapipe_capture import capturePipeline
+    from facecapture.frame_source import EndOfStream
+    from facecapture.preview import update_windows
+
+    shm = _attach(shm_name)
+    ring = SharedLandmarkRing(shm.buf, nslots)
+    read, process, release = capturePipeline(source, realtime, roi, inference_size, max_num_faces=max_num_faces)
+
+    try:
+        while not ring.header['stop']:
+            image, timestamp = read()
+            faces, close = process(image, bool(ring.header['show_cam']), timestamp)
+            # HighGUI runs on this process's main thread
+            update_windows()
+            ring.write(faces, close, timestamp)
+    except EndOfStream:
+        # exiting cleanly tells the parent the source is exhausted
+        pass
+    except Exception:
+        traceback.print_exc()
+        raise
+    finally:
+        release()
+        update_windows()
+        ring.release()
+        shm.close()
+
+
+# Capture pipeline running in a separate process
+# execute() starts it, cancel() stops it; a worker that dies is restarted
+# up to max_restarts times before the capture is aborted
+# Only the first face of every frame is shared with Blender
+class CaptureProcess:
+    def __init__(self, source, nslots=4, max_restarts=3, realtime=False, roi=False, inference_size=0, max_num_faces=1):
+        self.source = source
+        self.realtime = realtime
+        self.roi = roi
+        self.inference_size = inference_size
+        self.max_num_faces = max_num_faces
+        self.nslots = nslots
+        self.max_restarts = max_restarts
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context('spawn')
+        self._shm = shared_memory.SharedMemory(create=True, size=SharedLandmarkRing.size(nslots))
+        self.ring = SharedLandmarkRing(self._shm.buf, nslots)
+        self.ring.reset()
+
+        self._process = None
+        self._start()
+
+    def _start(self):
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(self._shm.name, self.nslots, self.source, self.realtime, self.roi, self.inference_size, self.max_num_faces),
+            name="facecapture-worker",
+            daemon=True
+        )
+        self._process.start()
+
+    def _restart(self):
+        if self._process.exitcode == 0:
+            from .frame_source import EndOfStream
+            raise EndOfStream()
+        if self.restarts >= self.max_restarts:
+            raise RuntimeError("Capture worker exited with code {} after {} restarts".format(
+                self._process.exitcode, self.restarts))
+
+        self.restarts += 1
+        print("\n>> Capture worker exited with code {}, restarting\n".format(self._process.exitcode))
+        self._process.join()
+        self.ring.header['stop'] = 0
+        self._start()
+
+    # Same contract as the function returned by asyncCapture
+    # The returned arrays belong to a frame copied out of shared memory
+    def capture(self, show_cam=False):
+        self.ring.header['show_cam'] = show_cam
+
+        slot = self.ring.read_latest()
+        if slot is None:
+            if not self._process.is_alive():
+                self._restart()
+            return [], False
+
+        faces = []
+        if slot['has_face']:
+            faces.append({
+                'landmark': slot['landmark'],
+                'iris': slot['iris'],
+                'metric_landmarks': slot['metric_landmarks'],
+                'pose_transform_mat': slot['pose_transform_mat'],
+                'timestamp': float(slot['timestamp']),
+            })
+        return faces, bool(slot['close'])
+
+    def stats(self):
+        return {
+            'worker': {
+                'alive': self._process is not None and self._process.is_alive(),
+                'restarts': self.restarts,
+                'written': int(self.ring.header['write_seq']),
+                'read': self.ring.last_seq,
+            },
+        }
+
+    def stop(self):
+        self.ring.header['stop'] = 1
+        self._process.join(timeout=2.0)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+        self.ring.release()
+        try:
+            self._shm.close()
+        except BufferError:
+            # a view into the block is still alive somewhere,
+            # it is freed once that is garbage collected
+            pass
+        self._shm.unlink()
+
+
+def processCapture(source, nslots=4, realtime=False, roi=False, inference_size=0, max_num_faces=1):
+    return CaptureProcess(source, nslots, realtime=realtime, roi=roi, inference_size=inference_size, max_num_faces=max_num_faces)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+
+from .mediapipe_capture import capturePipeline
+
+
+# Bounded ring buffer where the most recent item always wins
+# The producer never blocks: when the buffer is full the oldest item is
+# overwritten. The consumer drains only the newest item and discards the rest.
+class LatestFrameBuffer:
+    def __init__(self, capacity=2):
+        self.capacity = capacity
+        self._items = collections.deque(maxlen=capacity)
+        self._ready = threading.Condition()
+        self._closed = False
+
+        # items written by the producer
+        self.put_count = 0
+        # items overwritten before being read (producer outran the buffer)
+        self.dropped = 0
+        # stale items discarded by the consumer when draining the latest one
+        self.skipped = 0
+
+    def put(self, item):
+        with self._ready:
+            if len(self._items) == self.capacity:
+                self.dropped += 1
+            self._items.append(item)
+            self.put_count += 1
+            self._ready.notify()
+
+    # returns the newest item or None if the buffer stays empty until timeout
+    def get_latest(self, timeout=None):
+        with self._ready:
+            if len(self._items) == 0 and timeout is not None and not self._closed:
+                self._ready.wait(timeout)
+            if len(self._items) == 0:
+                return None
+
+            item = self._items.pop()
+            self.skipped += len(self._items)
+            self._items.clear()
+            return item
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def stats(self):
+        with self._ready:
+            return {
+                'depth': len(self._items),
+                'capacity': self.capacity,
+                'put': self.put_count,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+            }
+
+
+# Runs camera read and inference in background threads
+# source read -> frames buffer -> mediapipe + metric landmarks -> results buffer
+# capture() only drains the most recent result, so it never blocks Blender's UI
+class CaptureThread:
+    def __init__(self, read, process, release, capacity=2):
+        self._read = read
+        self._process = process
+        self._release = release
+
+        self.frames = LatestFrameBuffer(capacity)
+        self.results = LatestFrameBuffer(capacity)
+        self.show_cam = False
+        self.error = None
+
+        self._running = True
+        self._finished = False
+        self._threads = [
+            threading.Thread(target=self._read_loop, name="facecapture-camera", daemon=True),
+            threading.Thread(target=self._process_loop, name="facecapture-inference", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self._running = False
+        self.frames.close()
+
+    def _read_loop(self):
+        try:
+            while self._running:
+                self.frames.put(self._read())
+        except Exception as e:
+            # e.g. EndOfStream: frames already read are still processed, the
+            # error is raised once their results have been delivered
+            if self.error is None:
+                self.error = e
+            self.frames.close()
+
+    def _process_loop(self):
+        try:
+            while self._running:
+                frame = self.frames.get_latest(timeout=0.1)
+                if frame is None:
+                    if self.frames.closed:
+                        break
+                    continue
+                image, timestamp = frame
+                faces, close = self._process(image, self.show_cam, timestamp)
+                # 'landmark' and 'iris' are views into the pipeline's landmark
+                # buffer, which the next frame overwrites while this result waits
+                for face in faces:
+                    face['landmark'] = face['landmark'].copy()
+                    face['iris'] = face['iris'].copy()
+                self.results.put((faces, close))
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._finished = True
+
+    # Same contract as the function returned by asyncCapture
+    # returns ([], False) when no new frame was processed since the last call
+    # A worker error is raised only after the results queued before it
+    def capture(self, show_cam=False):
+        self.show_cam = show_cam
+
+        # read before draining, so a result put just before finishing is not missed
+        finished = self._finished
+        result = self.results.get_latest()
+        if result is None:
+            if finished and self.error is not None:
+                raise self.error
+            return [], False
+        return result
+
+    def stats(self):
+        return {
+            'camera': self.frames.stats(),
+            'inference': self.results.stats(),
+        }
+
+    def stop(self):
+        self._running = False
+        self.frames.close()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        self._release()
+
+
+def threadedCapture(source, capacity=2, realtime=False, roi=False, inference_size=0, max_num_faces=1):
+    read, process, release = capturePipeline(source, realtime, roi, inference_size, max_num_faces=max_num_faces)
+    return CaptureThread(read, process, release, capacity)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+# Compact index of the expressions stored as shape keys
+# Every entry is the (nv, 3) metric landmarks of one inserted expression and
+# the names of the shape keys created from it. Entries are embedded with PCA
+# and a frame's novelty is its distance to the nearest entry, computed in the
+# reduced space plus the frame's residual off the PCA subspace.
+class ExpressionIndex:
+    def __init__(self, components=16):
+        self.components = components
+        self.entries = np.empty((0, 0))
+        self.names = []
+        self.fixed = []
+        self._fit()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _fit(self):
+        n = self.entries.shape[0]
+        if n == 0:
+            self._mean = None
+            return
+
+        self._mean = self.entries.mean(axis=0)
+        centered = self.entries - self._mean
+        _, _, vh = np.linalg.svd(centered, full_matrices=False)
+        self._basis = vh[:min(self.components, n)]
+        self._embeddings = centered @ self._basis.T
+
+    # names: shape keys holding this expression
+    # fixed entries (the basis) are never evicted
+    def add(self, landmarks, names, fixed=False):
+        x = np.asarray(landmarks, dtype=np.float64).reshape(1, -1)
+        self.entries = x if len(self) == 0 else np.concatenate([self.entries, x])
+        self.names.append(list(names))
+        self.fixed.append(fixed)
+        self._fit()
+
+    def remove(self, index):
+        self.entries = np.delete(self.entries, index, axis=0)
+        del self.names[index]
+        del self.fixed[index]
+        self._fit()
+
+    # RMS per-landmark distance from landmarks to the nearest entry
+    # returns (distance, entry index), or (inf, None) for an empty index
+    def novelty(self, landmarks):
+        if self._mean is None:
+            return np.inf, None
+
+        x = np.asarray(landmarks, dtype=np.float64).reshape(-1) - self._mean
+        z = self._basis @ x
+        residual = max(x @ x - z @ z, 0.0)
+
+        distances = np.sum((self._embeddings - z) ** 2, axis=1) + residual
+        nearest = int(np.argmin(distances))
+        return np.sqrt(distances[nearest] * 3 / x.size), nearest
+
+    # Entry whose nearest neighbour is closest, i.e. the most redundant one
+    # returns None if every entry is fixed
+    def most_redundant(self):
+        evictable = [i for i, fixed in enumerate(self.fixed) if not fixed]
+        if len(evictable) == 0 or len(self) < 2:
+            return None
+
+        e = self._embeddings
+        distances = np.sum((e[evictable, None, :] - e[None, :, :]) ** 2, axis=2)
+        distances[np.arange(len(evictable)), evictable] = np.inf
+        return evictable[int(np.argmin(distances.min(axis=1)))]
@@ -14,52 +14,125 @@ from . import Blendshape
 if "Blendshape" in locals():
     importlib.reload(Blendshape)
 
+from . import preview
+if "preview" in locals():
+    importlib.reload(preview)
+
 from . import mediapipe_capture
 if "mediapipe_capture" in locals():
     importlib.reload(mediapipe_capture)
 
+from . import capture_thread
+if "capture_thread" in locals():
+    importlib.reload(capture_thread)
+
+from . import capture_process
+if "capture_process" in locals():
+    importlib.reload(capture_process)
+
+from . import expression_index
+if "expression_index" in locals():
+    importlib.reload(expression_index)
+
+from . import keyframe_recorder
+if "keyframe_recorder" in locals():
+    importlib.reload(keyframe_recorder)
+
+from . import landmark_recording
+if "landmark_recording" in locals():
+    importlib.reload(landmark_recording)
+
+from . import frame_source
+if "frame_source" in locals():
+    importlib.reload(frame_source)
+
+from . import profiling
+if "profiling" in locals():
+    importlib.reload(profiling)
+
+from . import Blendshape_retarget_manual
+if "Blendshape_retarget_manual" in locals():
+    importlib.reload(Blendshape_retarget_manual)
+
+from . import landmark_retarget
+if "landmark_retarget" in locals():
+    importlib.reload(landmark_retarget)
+
+from . import mesh_writer
+if "mesh_writer" in locals():
+    importlib.reload(mesh_writer)
+
+from . import temporal_filter
+if "temporal_filter" in locals():
+    importlib.reload(temporal_filter)
+
 from facecapture import createLandmarks as cl
 if "cl" in locals():
     importlib.reload(cl)
 
 asyncCapture = mediapipe_capture.asyncCapture
+threadedCapture = capture_thread.threadedCapture
+processCapture = capture_process.processCapture
 BlendshapeMesh = Blendshape.BlendshapeMesh
+ExpressionIndex = expression_index.ExpressionIndex
+KeyframeRecorder = keyframe_recorder.KeyframeRecorder
+LandmarkRecorder = landmark_recording.LandmarkRecorder
+replayCapture = landmark_recording.replayCapture
+EndOfStream = frame_source.EndOfStream
+MeshWriter = mesh_writer.MeshWriter
 
 from bpy.props import (
     FloatProperty,
 )
 
 # Utils
-def convertBlenderObj(obj) :
-    list = []
 
-    if obj.data.shape_keys is None:
-        verts = [v.co for v in obj.data.vertices]
-        list.append(verts)
-    else:
-        # With shape keys
-        kbs = obj.data.shape_keys.key_blocks
-
-        base_verts = kbs[0].data
-
-        for sk in kbs :
-            group_name = sk.vertex_group
-            verts = []
-            for i,vert in enumerate(sk.data) :
-                a = base_verts[i].co
-                b = vert.co
-
-                if group_name == '':
-                    verts.append(b)
-                else:
-                    try:
-                        w = obj.vertex_groups[group_name].weight(i)
-                    except:
-                        w = 0
-                    verts.append(a + w*(b-a))
-            list.append(verts)
-
-    return np.array(list)
+# Dense per-vertex weights for each named vertex group, gathered in a single
+# pass over the vertices. Missing groups and unassigned vertices weigh 0
+def vertex_group_weights(obj, group_names):
+    nverts = len(obj.data.vertices)
+    weights = {name: np.zeros(nverts, dtype=np.float32) for name in group_names}
+    indices = {obj.vertex_groups[name].index: weights[name] for name in group_names if name in obj.vertex_groups}
+
+    if len(indices) > 0:
+        for v in obj.data.vertices:
+            for g in v.groups:
+                w = indices.get(g.group)
+                if w is not None:
+                    w[v.index] = g.weight
+
+    return weights
+
+# Shape key coordinates as a (nkeys, nverts, 3) float32 array, with each key
+# blended against the first one by its vertex group weights
+# indices selects which key blocks to read (all of them by default)
+def convertBlenderObj(obj, indices=None) :
+    data = obj.data
+    nverts = len(data.vertices)
+
+    if data.shape_keys is None:
+        coords = np.empty((1, nverts, 3), dtype=np.float32)
+        data.vertices.foreach_get('co', coords.reshape(-1))
+        return coords
+
+    # With shape keys
+    kbs = data.shape_keys.key_blocks
+    keys = list(kbs) if indices is None else [kbs[i] for i in indices]
+    coords = np.empty((len(keys), nverts, 3), dtype=np.float32)
+    for i, sk in enumerate(keys):
+        sk.data.foreach_get('co', coords[i].reshape(-1))
+
+    groups = vertex_group_weights(obj, {sk.vertex_group for sk in keys if sk.vertex_group != ''})
+    if len(groups) > 0:
+        base_verts = np.empty((nverts, 3), dtype=np.float32)
+        kbs[0].data.foreach_get('co', base_verts.reshape(-1))
+
+    for i, sk in enumerate(keys):
+        if sk.vertex_group != '':
+            w = groups[sk.vertex_group][:, None]
+            coords[i] = base_verts + w * (coords[i] - base_verts)
+
+    return coords
 
 def updateWeightsBlender(obj, weights) :
     if obj.data.shape_keys is None:
@@ -69,38 +142,81 @@ def updateWeightsBlender(obj, weights) :
     for i, sk in enumerate(kbs[1:]) :
         sk.value = weights[i]
 
-def normalize_vertices(data, face):
-    lms = np.matrix(face['metric_landmarks'].T)
-    data.vertices.foreach_set('co', lms.A1)
-    data.update()
-    
-    return lms
-        
-def add_shape_keys(fc):
-    bpy.context.view_layer.objects.active = fc.blendshape_mesh
-    fc.landmark_mesh.select_set(True)
-
-    n = 0
-
-    for group in fc.blendshape_mesh.vertex_groups:
-        # if group is empty, ignore it
-        if not any(group.index in [g.group for g in v.groups] for v in fc.blendshape_mesh.data.vertices):
-            continue
+# Vertex groups of obj with at least one assigned vertex, in one pass
+def nonempty_vertex_groups(obj):
+    used = set()
+    for v in obj.data.vertices:
+        for g in v.groups:
+            used.add(g.group)
+
+    return [group for group in obj.vertex_groups if group.index in used]
+
+# Adds the landmark mesh's current shape as new shape keys of the blendshape
+# mesh, one per non-empty vertex group (or a single one if there are none).
+# Works on the data API only, so it needs no selection or active object.
+# coords: flat landmark coordinates, read from the landmark mesh if not given
+# groups: result of nonempty_vertex_groups, computed if not given
+def add_shape_keys(fc, coords=None, groups=None):
+    obj = fc.blendshape_mesh
+
+    if coords is None:
+        vertices = fc.landmark_mesh.data.vertices
+        coords = np.empty(3 * len(vertices), dtype=np.float32)
+        vertices.foreach_get('co', coords)
+    if groups is None:
+        groups = nonempty_vertex_groups(obj)
+
+    if obj.data.shape_keys is None:
+        obj.shape_key_add(name='Basis', from_mix=False)
 
-        bpy.ops.object.join_shapes()
-        shape_key = fc.blendshape_mesh.data.shape_keys.key_blocks[-1]
-        shape_key.name = 'key_' + group.name
+    for group in groups:
+        shape_key = obj.shape_key_add(name='key_' + group.name, from_mix=False)
+        shape_key.data.foreach_set('co', coords)
         shape_key.vertex_group = group.name
-        n = n+1
-    
-    if n == 0:
-        bpy.ops.object.join_shapes()
-        shape_key = fc.blendshape_mesh.data.shape_keys.key_blocks[-1]
-        shape_key.name = 'key'
 
-def print_time(label, time0, time1, total_time):
-    dif = time1 - time0
-    print(label, " {:20.10f}s = {:15.5f}%".format(dif, 100*dif/total_time))
+    if len(groups) == 0:
+        shape_key = obj.shape_key_add(name='key', from_mix=False)
+        shape_key.data.foreach_set('co', coords)
+
+# Expression index seeded with the shape keys obj already has
+# Consecutive keys with identical coordinates were inserted together (one per
+# vertex group) and share one entry; the basis is a fixed entry
+def build_expression_index(obj):
+    index = ExpressionIndex()
+    data = obj.data
+    nverts = len(data.vertices)
+    coords = np.empty(3 * nverts, dtype=np.float32)
+
+    if data.shape_keys is None:
+        data.vertices.foreach_get('co', coords)
+        index.add(coords, [], fixed=True)
+        return index
+
+    kbs = data.shape_keys.key_blocks
+    kbs[0].data.foreach_get('co', coords)
+    index.add(coords, [kbs[0].name], fixed=True)
+
+    previous = None
+    names = []
+    for sk in kbs[1:]:
+        sk.data.foreach_get('co', coords)
+        if previous is not None and np.array_equal(previous, coords):
+            names.append(sk.name)
+            continue
+        if previous is not None:
+            index.add(previous, names)
+        previous = coords.copy()
+        names = [sk.name]
+    if previous is not None:
+        index.add(previous, names)
+
+    return index
+
+# Redraws the sidebar so the profiling panel follows the capture
+def redraw_panels(context):
+    for area in context.screen.areas:
+        if area.type == 'VIEW_3D':
+            area.tag_redraw()
 
 class FaceCaptureModal(bpy.types.Operator):
     """Face capture landmark to mesh"""
@@ -109,24 +225,153 @@ class FaceCaptureModal(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     _mesh = None
+    _key_names = []
     _timer = None
     _capture = None
     _endCapture = None
-
+    _worker = None
+    _index = None
+    _frames_since_insert = 0
+    _keys_changed = False
+    _recorder = None
+    _record_start = None
+    _landmark_recorder = None
+    _mesh_writer = None
+    _landmark_filter = None
+    _weight_filter = None
+    _last_redraw = 0.0
+    _unbound_reported = False
+
+    def rebuild_mesh(self, blendshape_mesh_obj, key_names):
+        self._mesh = BlendshapeMesh(convertBlenderObj(blendshape_mesh_obj))
+        self._key_names = key_names
+
+    # Keeps self._mesh in sync with the object's shape keys
+    # Deleted keys are removed and keys added at the end are appended in
+    # place; anything else (new basis, reordered or renamed keys) rebuilds
     def update_mesh(self, blendshape_mesh_obj):
         shape_keys = blendshape_mesh_obj.data.shape_keys
         nb = 0 if shape_keys is None else len(shape_keys.key_blocks)
-        nw = 0 if self._mesh is None else len(self._mesh.weights)+1
-        if self._mesh is None or nw != nb:
-            self._mesh = BlendshapeMesh(convertBlenderObj(blendshape_mesh_obj))
+        if self._mesh is not None and nb == len(self._key_names) and not self._keys_changed:
+            return
+        self._keys_changed = False
+
+        key_names = [] if shape_keys is None else [sk.name for sk in shape_keys.key_blocks]
+        old_names = self._key_names
+        if self._mesh is None or nb == 0 or len(old_names) == 0 or key_names[0] != old_names[0]:
+            self.rebuild_mesh(blendshape_mesh_obj, key_names)
+            return
+
+        kept = [name for name in old_names if name in key_names]
+        if key_names[:len(kept)] != kept:
+            self.rebuild_mesh(blendshape_mesh_obj, key_names)
+            return
+
+        # key blocks include the basis, mesh keys do not
+        removed = [i for i, name in enumerate(old_names) if name not in key_names]
+        for i in reversed(removed):
+            self._mesh.remove_key(i - 1)
+
+        added = range(len(kept), nb)
+        if len(added) > 0:
+            for coords in convertBlenderObj(blendshape_mesh_obj, added):
+                self._mesh.append_key(coords)
+
+        self._key_names = key_names
+
+    # Inserts lms as new shape keys when it is far enough from every expression
+    # already in the library, without solving for weights first. Keeps at
+    # least min_key_spacing frames between insertions and, past
+    # max_shape_keys, evicts the most redundant expression
+    def insert_novel_expression(self, fc, blendshape_mesh_obj, lms):
+        if self._index is None:
+            self._index = build_expression_index(blendshape_mesh_obj)
+
+        self._frames_since_insert += 1
+        if self._frames_since_insert < fc.min_key_spacing:
+            return
+
+        novelty, _ = self._index.novelty(lms)
+        if novelty <= fc.novelty_threshold:
+            return
 
-    def calculate_weights(self, blendshape_mesh_obj, lms):
+        shape_keys = blendshape_mesh_obj.data.shape_keys
+        nb = 1 if shape_keys is None else len(shape_keys.key_blocks)
+        add_shape_keys(fc, np.asarray(lms, dtype=np.float32).ravel())
+
+        kbs = blendshape_mesh_obj.data.shape_keys.key_blocks
+        self._index.add(lms, [sk.name for sk in kbs[nb:]])
+        self._frames_since_insert = 0
+        self._keys_changed = True
+
+        while fc.max_shape_keys > 0 and len(kbs) - 1 > fc.max_shape_keys:
+            evict = self._index.most_redundant()
+            if evict is None:
+                break
+            for name in self._index.names[evict]:
+                sk = kbs.get(name)
+                if sk is not None:
+                    blendshape_mesh_obj.shape_key_remove(sk)
+            self._index.remove(evict)
+
+    def calculate_weights(self, fc, blendshape_mesh_obj, lms, timestamp=None):
         self.update_mesh(blendshape_mesh_obj)
 
-        weights, error = self._mesh.get_weights(lms)
+        if fc.solver == 'BOUNDED':
+            weights, error = self._mesh.get_weights_bounded(
+                lms,
+                regularization=fc.regularization,
+                temporal=fc.temporal_weight
+            )
+        else:
+            weights, error = self._mesh.get_weights(lms)
+        if self._weight_filter is not None:
+            weights = self._weight_filter.filter(weights, timestamp)
         updateWeightsBlender(blendshape_mesh_obj, weights)
 
-        return error
+        return weights, error
+
+    # Landmark and weight filters following the settings, so they can be tuned
+    # while capturing; a filter of another kind starts from scratch
+    def update_filters(self, fc):
+        def configure(current, enabled):
+            if not enabled or fc.landmark_filter == 'NONE':
+                return None
+            cls = temporal_filter.FILTERS[fc.landmark_filter]
+            if not isinstance(current, cls):
+                current = cls(default_dt=1.0 / fc.fps)
+            if fc.landmark_filter == 'ONE_EURO':
+                current.min_cutoff = fc.filter_min_cutoff
+                current.beta = fc.filter_beta
+            else:
+                current.process_noise = fc.filter_process_noise
+                current.measurement_noise = fc.filter_measurement_noise
+            return current
+
+        self._landmark_filter = configure(self._landmark_filter, True)
+        self._weight_filter = configure(self._weight_filter, fc.filter_weights)
+
+    # Buffers weights for keyframing at the scene frame matching the time
+    # elapsed since recording started, so takes play back in real time
+    def record_keyframes(self, context, blendshape_mesh_obj, weights):
+        fc = context.scene.fc_settings
+        scene = context.scene
+
+        if self._recorder is None:
+            self._recorder = KeyframeRecorder()
+            self._record_start = (scene.frame_current, time.time())
+        self._recorder.flush_every = fc.keyframe_flush_frames
+        self._recorder.tolerance = fc.keyframe_tolerance
+
+        start_frame, start_time = self._record_start
+        frame = start_frame + (time.time() - start_time) * scene.render.fps / scene.render.fps_base
+        self._recorder.record(blendshape_mesh_obj, frame, self._key_names[1:], weights)
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.flush()
+        self._recorder = None
+        self._record_start = None
 
     def modal(self, context, event):
         fc = context.scene.fc_settings
@@ -139,36 +384,86 @@ class FaceCaptureModal(bpy.types.Operator):
 
         if event.type == 'TIMER':
             try:
-                time0 = time.time()
+                frame_start = time.perf_counter_ns()
                 faces, close = self._capture(fc.show_cam)
+                # the preview window can only be shown from this thread
+                preview.update_windows()
                 time1 = time.time()
 
+                # threaded and process capture return no faces when there is
+                # no new frame, so only frames with a face are recorded
+                timestamp = faces[0].get('timestamp') if len(faces) > 0 else None
+                if timestamp is None:
+                    timestamp = time1
+                if self._landmark_recorder is not None and len(faces) > 0:
+                    self._landmark_recorder.write(faces, close, timestamp)
+
                 if close:
                     fc.show_cam = False
 
                 if len(faces) == 0:
+                    if getattr(self._worker, 'finished', False):
+                        # end of a replayed recording, checked only once a
+                        # tick comes back empty so its last frame is applied
+                        self.cancel(context)
+                        return {'FINISHED'}
                     return {'PASS_THROUGH'}
 
                 # Use first face found
-                lms = normalize_vertices(landmarks_mesh_obj.data, faces[0])
-                time2 = time.time()
-
-                if blendshape_mesh_obj is None:
-                    return {'PASS_THROUGH'}
-
-                error = self.calculate_weights(blendshape_mesh_obj, lms)
-                #print("error ", error)
-                if error > fc.tolerance:
-                    add_shape_keys(fc)
-                time3 = time.time()
-        
-                total_time = time3 - time0
-                print_time("d1    ", time0, time1, total_time)
-                print_time("d2    ", time1, time2, total_time)
-                print_time("d3    ", time2, time3, total_time)
-                print_time("Total:", time0, time3, total_time)
-                print("{:30.10f} fps".format(1/total_time))
-
+                self.update_filters(fc)
+                with profiling.span('mesh'):
+                    lms = self._mesh_writer.write(landmarks_mesh_obj.data, faces[0], self._landmark_filter, timestamp)
+
+                if blendshape_mesh_obj is not None:
+                    if fc.insertion_mode == 'NOVELTY':
+                        with profiling.span('insert'):
+                            self.insert_novel_expression(fc, blendshape_mesh_obj, lms)
+                        with profiling.span('weights'):
+                            weights, error = self.calculate_weights(fc, blendshape_mesh_obj, lms, timestamp)
+                    else:
+                        with profiling.span('weights'):
+                            weights, error = self.calculate_weights(fc, blendshape_mesh_obj, lms, timestamp)
+                        #print("error ", error)
+                        if error > fc.tolerance:
+                            with profiling.span('insert'):
+                                add_shape_keys(fc, np.asarray(lms, dtype=np.float32).ravel())
+
+                    if fc.live_retarget and fc.retarget_mesh is not None and fc.retarget_mode == 'SHAPE_KEYS':
+                        with profiling.span('retarget'):
+                            Blendshape_retarget_manual.retarget(blendshape_mesh_obj, fc.retarget_mesh)
+
+                    with profiling.span('keyframes'):
+                        if fc.auto_insert:
+                            self.record_keyframes(context, blendshape_mesh_obj, weights)
+                        elif self._recorder is not None:
+                            self.stop_recording()
+
+                # deform the target straight from the landmarks, no blendshape mesh needed
+                if fc.live_retarget and fc.retarget_mesh is not None and fc.retarget_mode == 'LANDMARKS':
+                    mapping = landmark_retarget.get_mapping(landmarks_mesh_obj, fc.retarget_mesh)
+                    if mapping is not None:
+                        self._unbound_reported = False
+                        with profiling.span('retarget'):
+                            landmark_retarget.apply(mapping, fc.retarget_mesh, lms)
+                    elif not self._unbound_reported:
+                        # reported once, capture goes on without the target
+                        self._unbound_reported = True
+                        self.report({'WARNING'}, "Run Bind to Landmarks to retarget to %s" % fc.retarget_mesh.name)
+
+                profiler = profiling.get_profiler()
+                if profiler is not None:
+                    profiler.add('frame', frame_start, time.perf_counter_ns())
+                    profiler.frame()
+                    if self._worker is not None:
+                        profiler.counters = self._worker.stats()
+                    if time1 - self._last_redraw > 0.5:
+                        self._last_redraw = time1
+                        redraw_panels(context)
+
+            except EndOfStream:
+                # video file or image sequence played to the end
+                self.cancel(context)
+                return {'FINISHED'}
             except Exception as e :
                 self.cancel(context)
                 print("\n>> Error when updating mesh\n")
@@ -189,7 +484,31 @@ class FaceCaptureModal(bpy.types.Operator):
                 obj = object_utils.object_data_add(context, mesh)
                 context.scene.fc_settings.landmark_mesh = obj 
 
-            self._capture, self._endCapture = asyncCapture(context.scene.fc_settings.camera_index)
+            fc = context.scene.fc_settings
+            if fc.frame_source == 'CAMERA':
+                source, realtime = fc.camera_index, False
+            else:
+                # files play back at their own frame rate
+                source, realtime = bpy.path.abspath(fc.source_path), True
+
+            # synchronous capture solves the metric landmarks straight into
+            # the mesh buffer, the other modes hand over their own arrays
+            self._mesh_writer = MeshWriter()
+            if fc.capture_mode == 'THREAD':
+                self._worker = threadedCapture(source, realtime=realtime, roi=fc.roi_tracking, inference_size=fc.inference_size, max_num_faces=fc.max_faces)
+                self._capture, self._endCapture = self._worker.capture, self._worker.stop
+            elif fc.capture_mode == 'PROCESS':
+                self._worker = processCapture(source, realtime=realtime, roi=fc.roi_tracking, inference_size=fc.inference_size, max_num_faces=fc.max_faces)
+                self._capture, self._endCapture = self._worker.capture, self._worker.stop
+            elif fc.capture_mode == 'REPLAY':
+                self._worker = replayCapture(bpy.path.abspath(fc.recording_path), fc.replay_realtime)
+                self._capture, self._endCapture = self._worker.capture, self._worker.stop
+            else:
+                self._capture, self._endCapture = asyncCapture(source, realtime, fc.roi_tracking, fc.inference_size, self._mesh_writer.buffer, fc.max_faces)
+
+            if fc.record_landmarks and fc.capture_mode != 'REPLAY':
+                # every take gets its own directory, earlier takes are kept
+                self._landmark_recorder = LandmarkRecorder(landmark_recording.new_take_path(bpy.path.abspath(fc.recording_path)))
         except:
             return {'CANCELLED'}
 
@@ -199,8 +518,18 @@ class FaceCaptureModal(bpy.types.Operator):
     def cancel(self, context):
         # free mediapipe resources
         self._endCapture()
+        preview.update_windows()
+        self.stop_recording()
+        if self._landmark_recorder is not None:
+            self._landmark_recorder.close()
+            self._landmark_recorder = None
         self._capture = None
         self._endCapture = None
+        self._worker = None
+        self._index = None
+        self._mesh_writer = None
+        self._landmark_filter = None
+        self._weight_filter = None
         # Unlink modal event
         wm = context.window_manager
         wm.event_timer_remove(self._timer)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import cv2
+
+
+# Region of the frame the face is searched in, tracked from the landmarks of
+# the previous frame
+# Boxes are (x, y, width, height) in pixels of the mirrored frame, which is
+# the frame the landmarks refer to. While no face is tracked the box is the
+# whole frame.
+class FaceROI:
+    def __init__(self, frame_height, frame_width, margin=1.6, min_size=64):
+        self.frame_height = frame_height
+        self.frame_width = frame_width
+        self.margin = margin
+        self.min_size = min_size
+        self.box = None
+
+    def full_frame(self):
+        return 0, 0, self.frame_width, self.frame_height
+
+    def reset(self):
+        self.box = None
+
+    # Square box around the face landmarks (n, 3), normalised to the frame,
+    # grown by margin and kept inside the frame
+    def update(self, points):
+        x = points[:, 0] * self.frame_width
+        y = points[:, 1] * self.frame_height
+        x_min, x_max = x.min(), x.max()
+        y_min, y_max = y.min(), y.max()
+
+        size = max(x_max - x_min, y_max - y_min) * self.margin
+        size = int(min(max(size, self.min_size), self.frame_width, self.frame_height))
+        x0 = int((x_min + x_max - size) / 2)
+        y0 = int((y_min + y_max - size) / 2)
+        x0 = min(max(x0, 0), self.frame_width - size)
+        y0 = min(max(y0, 0), self.frame_height - size)
+        self.box = (x0, y0, size, size)
+
+    # Mirrored RGB crop of the current box, downscaled so that its longest
+    # side is at most max_size (0 keeps the full resolution)
+    # The frame itself is neither flipped nor converted, only the crop is
+    def crop(self, image, max_size=0):
+        x0, y0, w, h = self.box or self.full_frame()
+        # the box is in mirrored coordinates, crop the same pixels unmirrored
+        x0 = self.frame_width - x0 - w
+        crop = image[y0:y0 + h, x0:x0 + w]
+
+        scale = 1.0 if max_size <= 0 else max_size / max(w, h)
+        if scale < 1.0:
+            crop = cv2.resize(crop, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+        return cv2.cvtColor(cv2.flip(crop, 1), cv2.COLOR_BGR2RGB)
+
+    # Maps points (n, 3) normalised to the crop of box back to the full frame
+    # in place; z is scaled like x, as mediapipe does
+    def reproject(self, points, box):
+        x0, y0, w, h = box
+        points[:, 0] = points[:, 0] * (w / self.frame_width) + x0 / self.frame_width
+        points[:, 1] = points[:, 1] * (h / self.frame_height) + y0 / self.frame_height
+        points[:, 2] *= w / self.frame_width
+        return points
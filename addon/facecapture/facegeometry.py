@@ -10,19 +10,47 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+# Debugging traces the dense solver, the only one with the intermediate hooks
+# the C++ parity checks need; the sparse solver is used again when it is off
 class Debugger(metaclass=Singleton):
     def set_debug(self, debug):
         self.debug = debug
+        set_tracer(CppTracer() if debug else None)
+        use_sparse_solver(not debug)
 
     def toggle(self):
-        self.debug = not self.debug
+        self.set_debug(not self.debug)
 
     def get_debug(self):
         return self.debug
 
 
-DEBUG = Debugger()
-DEBUG.set_debug(False)
+# Compares intermediate solver matrices against dumps of the mediapipe C++
+# implementation (<name>_cpp.npy in the working directory)
+class CppTracer:
+    def log(self, name, f):
+        print(f"{name} logged:", f)
+        print()
+
+    def compare(self, name, np_matrix):
+        # reorder cpp matrix as memory alignment is not correct
+        cpp_matrix = np.load(f"{name}_cpp.npy")
+        rows, cols = cpp_matrix.shape
+        cpp_matrix = np.split(np.reshape(cpp_matrix, -1), cols)
+        cpp_matrix = np.stack(cpp_matrix, 1)
+
+        print(f"{name}:", np.sum(np.abs(cpp_matrix - np_matrix[:rows, :cols]) ** 2))
+        print()
+
+
+# Tracer called by the solver hooks, None when debugging is off
+# Hooks only run (and only build their arguments) while a tracer is attached
+_tracer = None
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
 
 
 class PCF:
@@ -283,26 +311,21 @@ landmark_weights = np.zeros((canonical_metric_landmarks.shape[1],))
 for idx, weight in procrustes_landmark_basis:
     landmark_weights[idx] = weight
 
-
-def log(name, f):
-    if DEBUG.get_debug():
-        print(f"{name} logged:", f)
-        print()
-
-
-def cpp_compare(name, np_matrix):
-    if DEBUG.get_debug():
-        # reorder cpp matrix as memory alignment is not correct
-        cpp_matrix = np.load(f"{name}_cpp.npy")
-        rows, cols = cpp_matrix.shape
-        cpp_matrix = np.split(np.reshape(cpp_matrix, -1), cols)
-        cpp_matrix = np.stack(cpp_matrix, 1)
-
-        print(f"{name}:", np.sum(np.abs(cpp_matrix - np_matrix[:rows, :cols]) ** 2))
-        print()
-
-
-def get_metric_landmarks(screen_landmarks, pcf):
+# Only the procrustes basis landmarks have non-zero weight, so everything that
+# depends on the canonical sources alone is computed once here and each
+# per-frame solve works on that gathered subset (see solve_canonical_sparse)
+sparse_landmark_indices = np.flatnonzero(landmark_weights)
+sparse_sqrt_weights = np.sqrt(landmark_weights[sparse_landmark_indices])
+sparse_total_weight = np.sum(sparse_sqrt_weights * sparse_sqrt_weights)
+sparse_weighted_sources = canonical_metric_landmarks[:, sparse_landmark_indices] * sparse_sqrt_weights[None, :]
+sparse_source_center_of_mass = np.sum(sparse_weighted_sources * sparse_sqrt_weights[None, :], axis=1) / sparse_total_weight
+sparse_centered_weighted_sources = sparse_weighted_sources - np.matmul(sparse_source_center_of_mass[:, None],
+                                                                       sparse_sqrt_weights[None, :])
+
+
+# out: optional C-contiguous (468, 3) array (e.g. float32 mesh coordinates)
+# the metric landmarks are written to, returned as its (3, 468) transpose
+def get_metric_landmarks(screen_landmarks, pcf, out=None):
     screen_landmarks = project_xy(screen_landmarks, pcf)
     depth_offset = np.mean(screen_landmarks[2, :])
 
@@ -316,21 +339,58 @@ def get_metric_landmarks(screen_landmarks, pcf):
     intermediate_landmarks = change_handedness(intermediate_landmarks)
     second_iteration_scale = estimate_scale(intermediate_landmarks)
 
-    metric_landmarks = screen_landmarks.copy()
+    metric_landmarks = screen_landmarks
     total_scale = first_iteration_scale * second_iteration_scale
     metric_landmarks = move_and_rescale_z(pcf, depth_offset, total_scale, metric_landmarks)
     metric_landmarks = unproject_xy(pcf, metric_landmarks)
     metric_landmarks = change_handedness(metric_landmarks)
 
-    pose_transform_mat = solve_weighted_orthogonal_problem(canonical_metric_landmarks, metric_landmarks,
-                                                           landmark_weights)
-    cpp_compare("pose_transform_mat", pose_transform_mat)
+    pose_transform_mat = solve_canonical(metric_landmarks)
+    if _tracer:
+        _tracer.compare("pose_transform_mat", pose_transform_mat)
 
     inv_pose_transform_mat = np.linalg.inv(pose_transform_mat)
     inv_pose_rotation = inv_pose_transform_mat[:3, :3]
     inv_pose_translation = inv_pose_transform_mat[:3, 3]
 
-    metric_landmarks = inv_pose_rotation @ metric_landmarks + inv_pose_translation[:, None]
+    if out is None:
+        metric_landmarks = inv_pose_rotation @ metric_landmarks + inv_pose_translation[:, None]
+        return metric_landmarks, pose_transform_mat
+
+    np.matmul(metric_landmarks.T, inv_pose_rotation.T, out=out)
+    out += inv_pose_translation
+    return out.T, pose_transform_mat
+
+
+# Batched get_metric_landmarks for a (N, 3, 468) stack of faces or frames
+# returns (N, 3, 468) metric landmarks and (N, 4, 4) pose transforms
+def get_metric_landmarks_batch(screen_landmarks, pcf):
+    screen_landmarks = project_xy(screen_landmarks, pcf)
+    depth_offset = np.mean(screen_landmarks[:, 2, :], axis=1)[:, None]
+
+    intermediate_landmarks = screen_landmarks.copy()
+    intermediate_landmarks = change_handedness(intermediate_landmarks)
+    first_iteration_scale = estimate_scale_batch(intermediate_landmarks)
+
+    intermediate_landmarks = screen_landmarks.copy()
+    intermediate_landmarks = move_and_rescale_z(pcf, depth_offset, first_iteration_scale[:, None], intermediate_landmarks)
+    intermediate_landmarks = unproject_xy(pcf, intermediate_landmarks)
+    intermediate_landmarks = change_handedness(intermediate_landmarks)
+    second_iteration_scale = estimate_scale_batch(intermediate_landmarks)
+
+    metric_landmarks = screen_landmarks
+    total_scale = first_iteration_scale * second_iteration_scale
+    metric_landmarks = move_and_rescale_z(pcf, depth_offset, total_scale[:, None], metric_landmarks)
+    metric_landmarks = unproject_xy(pcf, metric_landmarks)
+    metric_landmarks = change_handedness(metric_landmarks)
+
+    pose_transform_mat = solve_canonical_sparse_batch(metric_landmarks)
+
+    inv_pose_transform_mat = np.linalg.inv(pose_transform_mat)
+    inv_pose_rotation = inv_pose_transform_mat[:, :3, :3]
+    inv_pose_translation = inv_pose_transform_mat[:, :3, 3]
+
+    metric_landmarks = inv_pose_rotation @ metric_landmarks + inv_pose_translation[:, :, None]
 
     return metric_landmarks, pose_transform_mat
 
@@ -341,39 +401,103 @@ def project_xy(landmarks, pcf):
     x_translation = pcf.left
     y_translation = pcf.bottom
 
-    landmarks[1, :] = 1.0 - landmarks[1, :]
+    landmarks[..., 1, :] = 1.0 - landmarks[..., 1, :]
 
-    landmarks = landmarks * np.array([[x_scale, y_scale, x_scale]]).T
-    landmarks = landmarks + np.array([[x_translation, y_translation, 0]]).T
+    landmarks *= np.array([[x_scale, y_scale, x_scale]]).T
+    landmarks += np.array([[x_translation, y_translation, 0]]).T
 
     return landmarks
 
 
 def change_handedness(landmarks):
-    landmarks[2, :] *= -1.0
+    landmarks[..., 2, :] *= -1.0
 
     return landmarks
 
 
 def move_and_rescale_z(pcf, depth_offset, scale, landmarks):
-    landmarks[2, :] = (landmarks[2, :] - depth_offset + pcf.near) / scale
+    landmarks[..., 2, :] = (landmarks[..., 2, :] - depth_offset + pcf.near) / scale
 
     return landmarks
 
 
 def unproject_xy(pcf, landmarks):
-    landmarks[0, :] = landmarks[0, :] * landmarks[2, :] / pcf.near
-    landmarks[1, :] = landmarks[1, :] * landmarks[2, :] / pcf.near
+    landmarks[..., 0, :] = landmarks[..., 0, :] * landmarks[..., 2, :] / pcf.near
+    landmarks[..., 1, :] = landmarks[..., 1, :] * landmarks[..., 2, :] / pcf.near
 
     return landmarks
 
 
 def estimate_scale(landmarks):
-    transform_mat = solve_weighted_orthogonal_problem(canonical_metric_landmarks, landmarks, landmark_weights)
+    transform_mat = solve_canonical(landmarks)
 
     return np.linalg.norm(transform_mat[:, 0])
 
 
+# Solves the weighted orthogonal problem from the canonical face to targets
+# using every landmark column, as in the reference implementation
+def solve_canonical_dense(targets):
+    return solve_weighted_orthogonal_problem(canonical_metric_landmarks, targets, landmark_weights)
+
+
+# Same solve restricted to the landmarks with non-zero weight, using the
+# canonical sources precomputed at import
+def solve_canonical_sparse(targets):
+    weighted_targets = targets[:, sparse_landmark_indices] * sparse_sqrt_weights[None, :]
+
+    design_matrix = np.matmul(weighted_targets, sparse_centered_weighted_sources.T)
+    rotation = compute_optimal_rotation(design_matrix)
+
+    scale = compute_optimal_scale(sparse_centered_weighted_sources, sparse_weighted_sources, weighted_targets, rotation)
+    rotation_and_scale = scale * rotation
+
+    pointwise_diffs = weighted_targets - np.matmul(rotation_and_scale, sparse_weighted_sources)
+    weighted_pointwise_diffs = pointwise_diffs * sparse_sqrt_weights[None, :]
+    translation = np.sum(weighted_pointwise_diffs, axis=1) / sparse_total_weight
+
+    return combine_transform_matrix(rotation_and_scale, translation)
+
+
+# Batched solve_canonical_sparse for (N, 3, 468) targets, returns (N, 4, 4)
+def solve_canonical_sparse_batch(targets):
+    weighted_targets = targets[:, :, sparse_landmark_indices] * sparse_sqrt_weights[None, None, :]
+
+    design_matrix = np.matmul(weighted_targets, sparse_centered_weighted_sources.T)
+    rotation = compute_optimal_rotation_batch(design_matrix)
+
+    numerator = np.einsum('nij,jk,nik->n', rotation, sparse_centered_weighted_sources, weighted_targets)
+    denominator = np.sum(sparse_centered_weighted_sources * sparse_weighted_sources)
+    rotation_and_scale = (numerator / denominator)[:, None, None] * rotation
+
+    pointwise_diffs = weighted_targets - np.matmul(rotation_and_scale, sparse_weighted_sources)
+    weighted_pointwise_diffs = pointwise_diffs * sparse_sqrt_weights[None, None, :]
+    translation = np.sum(weighted_pointwise_diffs, axis=2) / sparse_total_weight
+
+    transform_mat = np.zeros((targets.shape[0], 4, 4))
+    transform_mat[:, :3, :3] = rotation_and_scale
+    transform_mat[:, :3, 3] = translation
+    transform_mat[:, 3, 3] = 1.0
+    return transform_mat
+
+
+def estimate_scale_batch(landmarks):
+    transform_mat = solve_canonical_sparse_batch(landmarks)
+
+    return np.linalg.norm(transform_mat[:, :, 0], axis=1)
+
+
+solve_canonical = solve_canonical_sparse
+
+
+def use_sparse_solver(enabled):
+    global solve_canonical
+    solve_canonical = solve_canonical_sparse if enabled else solve_canonical_dense
+
+
+DEBUG = Debugger()
+DEBUG.set_debug(False)
+
+
 def extract_square_root(point_weights):
     return np.sqrt(point_weights)
 
@@ -385,20 +509,24 @@ def solve_weighted_orthogonal_problem(source_points, target_points, point_weight
 
 
 def internal_solve_weighted_orthogonal_problem(sources, targets, sqrt_weights):
-    cpp_compare("sources", sources)
-    cpp_compare("targets", targets)
+    tracer = _tracer
+    if tracer:
+        tracer.compare("sources", sources)
+        tracer.compare("targets", targets)
 
     # tranposed(A_w).
     weighted_sources = sources * sqrt_weights[None, :]
     # tranposed(B_w).
     weighted_targets = targets * sqrt_weights[None, :]
 
-    cpp_compare("weighted_sources", weighted_sources)
-    cpp_compare("weighted_targets", weighted_targets)
+    if tracer:
+        tracer.compare("weighted_sources", weighted_sources)
+        tracer.compare("weighted_targets", weighted_targets)
 
     # w = tranposed(j_w) j_w.
     total_weight = np.sum(sqrt_weights * sqrt_weights)
-    log("total_weight", total_weight)
+    if tracer:
+        tracer.log("total_weight", total_weight)
 
     # Let C = (j_w tranposed(j_w)) / (tranposed(j_w) j_w).
     # Note that C = tranposed(C), hence (I - C) = tranposed(I - C).
@@ -409,40 +537,49 @@ def internal_solve_weighted_orthogonal_problem(sources, targets, sqrt_weights):
     # where c_w = tranposed(A_w) j_w / w is a k x 1 vector calculated here:
     twice_weighted_sources = weighted_sources * sqrt_weights[None, :]
     source_center_of_mass = np.sum(twice_weighted_sources, axis=1) / total_weight;
-    log("source_center_of_mass", source_center_of_mass)
+    if tracer:
+        tracer.log("source_center_of_mass", source_center_of_mass)
 
     # tranposed((I - C) A_w) = tranposed(A_w) (I - C) =
     # tranposed(A_w) - tranposed(A_w) C = tranposed(A_w) - c_w tranposed(j_w).
     centered_weighted_sources = weighted_sources - np.matmul(source_center_of_mass[:, None], sqrt_weights[None, :])
-    cpp_compare("centered_weighted_sources", centered_weighted_sources)
+    if tracer:
+        tracer.compare("centered_weighted_sources", centered_weighted_sources)
 
     design_matrix = np.matmul(weighted_targets, centered_weighted_sources.T)
-    cpp_compare("design_matrix", design_matrix)
-    log("design_matrix_norm", np.linalg.norm(design_matrix))
+    if tracer:
+        tracer.compare("design_matrix", design_matrix)
+        tracer.log("design_matrix_norm", np.linalg.norm(design_matrix))
 
     rotation = compute_optimal_rotation(design_matrix)
 
     scale = compute_optimal_scale(centered_weighted_sources, weighted_sources, weighted_targets, rotation)
-    log("scale", scale)
+    if tracer:
+        tracer.log("scale", scale)
 
     rotation_and_scale = scale * rotation;
 
     pointwise_diffs = weighted_targets - np.matmul(rotation_and_scale, weighted_sources)
-    cpp_compare("pointwise_diffs", pointwise_diffs)
+    if tracer:
+        tracer.compare("pointwise_diffs", pointwise_diffs)
 
     weighted_pointwise_diffs = pointwise_diffs * sqrt_weights[None, :]
-    cpp_compare("weighted_pointwise_diffs", weighted_pointwise_diffs)
+    if tracer:
+        tracer.compare("weighted_pointwise_diffs", weighted_pointwise_diffs)
 
     translation = np.sum(weighted_pointwise_diffs, axis=1) / total_weight
-    log("translation", translation)
+    if tracer:
+        tracer.log("translation", translation)
 
     transform_mat = combine_transform_matrix(rotation_and_scale, translation)
-    cpp_compare("transform_mat", transform_mat)
+    if tracer:
+        tracer.compare("transform_mat", transform_mat)
 
     return transform_mat
 
 
 def compute_optimal_rotation(design_matrix):
+    tracer = _tracer
     if np.linalg.norm(design_matrix) < 1e-9:
         print("Design matrix norm is too small!")
 
@@ -454,16 +591,28 @@ def compute_optimal_rotation(design_matrix):
     if np.linalg.det(postrotation) * np.linalg.det(prerotation) < 0:
         postrotation[:, 2] = -1 * postrotation[:, 2]
 
-    cpp_compare("postrotation", postrotation)
-    cpp_compare("prerotation", prerotation)
+    if tracer:
+        tracer.compare("postrotation", postrotation)
+        tracer.compare("prerotation", prerotation)
 
     rotation = np.matmul(postrotation, prerotation)
 
-    cpp_compare("rotation", rotation)
+    if tracer:
+        tracer.compare("rotation", rotation)
 
     return rotation
 
 
+# compute_optimal_rotation over a (N, 3, 3) stack of design matrices
+def compute_optimal_rotation_batch(design_matrix):
+    postrotation, _, prerotation = np.linalg.svd(design_matrix, full_matrices=True)
+
+    reflection = np.linalg.det(postrotation) * np.linalg.det(prerotation) < 0
+    postrotation[reflection, :, 2] *= -1
+
+    return np.matmul(postrotation, prerotation)
+
+
 def compute_optimal_scale(centered_weighted_sources, weighted_sources, weighted_targets, rotation):
     rotated_centered_weighted_sources = np.matmul(rotation, centered_weighted_sources)
 
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+# Raised by read() once a finite source has no more frames
+class EndOfStream(Exception):
+    pass
+
+
+# Raised by a non-blocking read() when the next frame is not decoded or due yet
+class FrameNotReady(Exception):
+    pass
+
+
+# Common interface of the frame sources
+# read() returns (image, timestamp) with a BGR image and the timestamp in
+# seconds; frame_height and frame_width are the size of the images delivered
+class FrameSource:
+    frame_height = 0
+    frame_width = 0
+    fps = 0.0
+
+    def read(self):
+        raise NotImplementedError
+
+    # positions a file source so the next read() returns frame index
+    def seek(self, index):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    @property
+    def frame_size(self):
+        return self.frame_height, self.frame_width
+
+
+# Frame size reported by an opened cv2.VideoCapture, reading a first frame
+# when the backend does not report it; returns the frame read, if any
+def _probe_size(source, cap):
+    source.frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    source.frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if source.frame_width > 0 and source.frame_height > 0:
+        return None
+
+    success, image = cap.read()
+    if not success:
+        raise RuntimeError("Falha ao ler o primeiro quadro")
+    source.frame_height, source.frame_width = image.shape[:2]
+    return image
+
+
+class CameraSource(FrameSource):
+    def __init__(self, camera_index):
+        self.cap = cv2.VideoCapture(camera_index)
+        if not self.cap.isOpened():
+            raise RuntimeError("Falha ao iniciar câmera")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self._pending = _probe_size(self, self.cap)
+
+    # cameras have no usable position, frames are stamped when read
+    def read(self):
+        if self._pending is not None:
+            image, self._pending = self._pending, None
+            return image, time.perf_counter()
+
+        success, image = self.cap.read()
+        if not success:
+            raise RuntimeError("Falha ao iniciar câmera")
+        return image, time.perf_counter()
+
+    def release(self):
+        self.cap.release()
+
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise RuntimeError("Could not open video {}".format(path))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.index = 0
+        self._pending = _probe_size(self, self.cap)
+
+    # timestamps come from the container, falling back to the frame rate
+    def read(self):
+        if self._pending is not None:
+            image, self._pending = self._pending, None
+        else:
+            success, image = self.cap.read()
+            if not success:
+                raise EndOfStream()
+
+        timestamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if timestamp <= 0 and self.index > 0:
+            timestamp = self.index / self.fps
+        self.index += 1
+        return image, timestamp
+
+    def seek(self, index):
+        if index != self.index:
+            self._pending = None
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.index = index
+
+    def release(self):
+        self.cap.release()
+
+
+# Sorted image files of a directory played as a sequence at fps
+class ImageDirectorySource(FrameSource):
+    def __init__(self, path, fps=30.0):
+        self.files = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if len(self.files) == 0:
+            raise RuntimeError("No images in {}".format(path))
+        self.fps = fps
+        self.index = 0
+
+        self._pending = self._load(0)
+        self.frame_height, self.frame_width = self._pending.shape[:2]
+
+    def _load(self, index):
+        image = cv2.imread(self.files[index], cv2.IMREAD_COLOR)
+        if image is None:
+            raise RuntimeError("Could not read image {}".format(self.files[index]))
+        return image
+
+    def read(self):
+        if self.index >= len(self.files):
+            raise EndOfStream()
+
+        if self._pending is not None:
+            image, self._pending = self._pending, None
+        else:
+            image = self._load(self.index)
+
+        timestamp = self.index / self.fps
+        self.index += 1
+        return image, timestamp
+
+    def seek(self, index):
+        if index != self.index:
+            self._pending = None
+            self.index = index
+
+
+# Decodes frames of a file source ahead of time in a background thread
+# read() blocks only when decoding falls behind, or raises FrameNotReady
+# instead when blocking is off (for callers on Blender's main thread). With
+# realtime set, the decode thread releases frames at their timestamps instead
+# of as fast as they are decoded.
+class PrefetchSource(FrameSource):
+    def __init__(self, source, depth=8, realtime=False, blocking=True):
+        self.source = source
+        self.frame_height, self.frame_width = source.frame_size
+        self.fps = source.fps
+        self.realtime = realtime
+        self.blocking = blocking
+
+        self._frames = queue.Queue(maxsize=depth)
+        self._running = True
+        self._start = None
+        self._thread = threading.Thread(target=self._decode_loop, name="facecapture-decode", daemon=True)
+        self._thread.start()
+
+    def _decode_loop(self):
+        while self._running:
+            try:
+                item = self.source.read()
+            except Exception as e:
+                item = e
+
+            if self.realtime and not isinstance(item, Exception):
+                self._wait_until_due(item[1])
+
+            while self._running:
+                try:
+                    self._frames.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            if isinstance(item, Exception):
+                return
+
+    # sleeps in short steps so release() does not wait a whole frame
+    def _wait_until_due(self, timestamp):
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now - timestamp
+        delay = self._start + timestamp - now
+        while delay > 0 and self._running:
+            time.sleep(min(delay, 0.1))
+            delay = self._start + timestamp - time.perf_counter()
+
+    def read(self):
+        if self.blocking:
+            while True:
+                try:
+                    item = self._frames.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if not self._running:
+                        raise EndOfStream()
+        else:
+            try:
+                item = self._frames.get_nowait()
+            except queue.Empty:
+                raise FrameNotReady()
+
+        if isinstance(item, Exception):
+            # keep raising on later calls
+            self._frames.put(item)
+            raise item
+        return item
+
+    def stats(self):
+        return {'depth': self._frames.qsize(), 'capacity': self._frames.maxsize}
+
+    def release(self):
+        self._running = False
+        self._thread.join(timeout=1.0)
+        self.source.release()
+
+
+# Opens a frame source from a camera index, a video file or an image directory
+# File sources are prefetched; realtime paces them at their recorded rate and
+# without blocking their read() raises FrameNotReady rather than waiting
+def open_source(source, realtime=False, prefetch=8, blocking=True):
+    if isinstance(source, FrameSource):
+        return source
+
+    if isinstance(source, int) or (isinstance(source, str) and source.isdigit()):
+        return CameraSource(int(source))
+
+    if os.path.isdir(source):
+        file_source = ImageDirectorySource(source)
+    else:
+        file_source = VideoFileSource(source)
+
+    if prefetch > 0 or realtime:
+        return PrefetchSource(file_source, max(prefetch, 1), realtime, blocking)
+    return file_source
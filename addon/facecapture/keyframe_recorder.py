@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import bpy
+import numpy as np
+
+
+# Indices of the points of the polyline (x, y) to keep so that every dropped
+# point lies within tolerance of the linear interpolation between the kept
+# ones (Ramer-Douglas-Peucker on the value axis). Endpoints are always kept.
+def reduce_keyframes(x, y, tolerance):
+    n = len(x)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        xs = x[first + 1:last]
+        t = (xs - x[first]) / (x[last] - x[first])
+        deviation = np.abs(y[first + 1:last] - (y[first] + t * (y[last] - y[first])))
+
+        worst = int(np.argmax(deviation))
+        if deviation[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return np.flatnonzero(keep)
+
+
+def _shape_key_fcurve(shape_keys, data_path):
+    anim = shape_keys.animation_data
+    if anim is None:
+        anim = shape_keys.animation_data_create()
+    if anim.action is None:
+        anim.action = bpy.data.actions.new(shape_keys.name + "Action")
+
+    action = anim.action
+    if hasattr(action, 'fcurve_ensure_for_datablock'):
+        # slotted actions (Blender 4.4+)
+        return action.fcurve_ensure_for_datablock(shape_keys, data_path)
+
+    fcurve = action.fcurves.find(data_path)
+    if fcurve is None:
+        fcurve = action.fcurves.new(data_path)
+    return fcurve
+
+
+# Buffers shape key weights during capture and writes them as keyframes in bulk
+# record() only appends to memory; flush() adds all buffered points of each
+# fcurve with one keyframe_points.add and one foreach_set, instead of one
+# keyframe_insert per key per frame. tolerance > 0 drops points that lie
+# within tolerance of the line through their neighbours before writing.
+class KeyframeRecorder:
+    def __init__(self, flush_every=0, tolerance=0.0):
+        self.flush_every = flush_every
+        self.tolerance = tolerance
+
+        self._frames = []
+        self._weights = []
+        self._names = None
+        self._target = None
+
+        # points recorded and points written after reduction
+        self.recorded = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    # obj: mesh object owning the shape keys
+    # names: names of the shape keys the weights belong to (basis excluded)
+    def record(self, obj, frame, names, weights):
+        names = tuple(names)
+        if self._target is not obj or self._names != names:
+            # shape keys were added or removed, write what we have under the old names
+            self.flush()
+            self._target = obj
+            self._names = names
+
+        self._frames.append(frame)
+        self._weights.append(np.array(weights, dtype=np.float32))
+        self.recorded += 1
+
+        if self.flush_every > 0 and len(self._frames) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self._frames) == 0:
+            return
+
+        obj, names = self._target, self._names
+        frames = np.asarray(self._frames, dtype=np.float32)
+        weights = np.stack(self._weights, axis=1)
+        self._frames = []
+        self._weights = []
+
+        shape_keys = obj.data.shape_keys
+        if shape_keys is None:
+            return
+
+        kbs = shape_keys.key_blocks
+        for name, values in zip(names, weights):
+            if kbs.get(name) is None:
+                continue
+
+            keep = reduce_keyframes(frames, values, self.tolerance)
+            co = np.empty((len(keep), 2), dtype=np.float32)
+            co[:, 0] = frames[keep]
+            co[:, 1] = values[keep]
+
+            fcurve = _shape_key_fcurve(shape_keys, 'key_blocks["{}"].value'.format(bpy.utils.escape_identifier(name)))
+            points = fcurve.keyframe_points
+            start = len(points)
+            points.add(len(keep))
+            if start == 0:
+                points.foreach_set('co', co.ravel())
+            else:
+                all_co = np.empty(2 * len(points), dtype=np.float32)
+                points.foreach_get('co', all_co)
+                all_co[2 * start:] = co.ravel()
+                points.foreach_set('co', all_co)
+            fcurve.update()
+
+            self.written += len(keep)
+
+    def clear(self):
+        self._frames = []
+        self._weights = []
+        self._names = None
+        self._target = None
+
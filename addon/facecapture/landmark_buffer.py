@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import itertools
+
+import numpy as np
+
+
+# 468 face mesh points plus 10 iris points when refine_landmarks is on
+NUM_LANDMARKS = 478
+NUM_FACE_LANDMARKS = 468
+
+# Wire layout of one NormalizedLandmark inside a serialized NormalizedLandmarkList
+# (field tag + length, then x, y and z as tagged little-endian floats)
+_LANDMARK_RECORD = np.dtype([
+    ('head', np.uint8, (2,)),
+    ('x_tag', np.uint8),
+    ('x', '<f4'),
+    ('y_tag', np.uint8),
+    ('y', '<f4'),
+    ('z_tag', np.uint8),
+    ('z', '<f4'),
+])
+_TAG_COLUMNS = [0, 1, 2, 7, 12]
+_TAG_VALUES = np.array([0x0a, 0x0f, 0x0d, 0x15, 0x1d], dtype=np.uint8)
+
+
+# Copies the x, y, z of a mediapipe NormalizedLandmarkList into out (n, 3)
+# The list is serialized once and decoded with a single numpy view. When
+# the message carries extra fields (visibility, presence) it falls back to
+# a flat fromiter over the landmark objects.
+def landmarks_to_array(landmark_list, out):
+    n = out.shape[0]
+    data = landmark_list.SerializeToString()
+
+    if len(data) == n * _LANDMARK_RECORD.itemsize:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(n, _LANDMARK_RECORD.itemsize)
+        if np.array_equal(raw[:, _TAG_COLUMNS], np.broadcast_to(_TAG_VALUES, (n, len(_TAG_VALUES)))):
+            records = np.frombuffer(data, dtype=_LANDMARK_RECORD)
+            out[:, 0] = records['x']
+            out[:, 1] = records['y']
+            out[:, 2] = records['z']
+            return out
+
+    out[:] = np.fromiter(
+        itertools.chain.from_iterable((lm.x, lm.y, lm.z) for lm in landmark_list.landmark),
+        dtype=out.dtype,
+        count=3 * n
+    ).reshape(n, 3)
+    return out
+
+
+# Preallocated (max_faces, 478, 3) float32 landmark storage reused every frame
+# Views returned by fill() are overwritten by the next frame
+class LandmarkBuffer:
+    def __init__(self, max_faces=1, num_landmarks=NUM_LANDMARKS):
+        self.data = np.zeros((max_faces, num_landmarks, 3), dtype=np.float32)
+
+    def fill(self, face_index, landmark_list):
+        n = len(landmark_list.landmark)
+        return landmarks_to_array(landmark_list, self.data[face_index, :n])
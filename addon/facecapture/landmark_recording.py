@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+import numpy as np
+
+from .capture_process import FRAME_DTYPE
+
+
+RECORDING_VERSION = 1
+META_FILE = "meta.json"
+CHUNK_FILE = "chunk_{:05d}.npy"
+TAKE_DIRECTORY = "take_%Y%m%d_%H%M%S"
+
+
+def is_recording(path):
+    return os.path.isfile(os.path.join(path, META_FILE)) or os.path.isfile(os.path.join(path, CHUNK_FILE.format(0)))
+
+
+# New, not yet existing take directory inside root named after the current time
+def new_take_path(root):
+    path = os.path.join(root, time.strftime(TAKE_DIRECTORY))
+    candidate, suffix = path, 1
+    while os.path.exists(candidate):
+        candidate = "{}_{}".format(path, suffix)
+        suffix += 1
+    return candidate
+
+
+# path itself when it holds a recording, else its most recent take
+def resolve_recording(path):
+    if is_recording(path):
+        return path
+    takes = sorted(
+        name for name in os.listdir(path)
+        if name.startswith("take_") and is_recording(os.path.join(path, name))
+    ) if os.path.isdir(path) else []
+    if len(takes) == 0:
+        raise FileNotFoundError("No landmark recording in {}".format(path))
+    return os.path.join(path, takes[-1])
+
+
+# Writes a landmark stream as a directory of .npy chunks
+# Every chunk is a 1-d array of FRAME_DTYPE records (the same layout as the
+# shared memory ring), so a recording can be memory-mapped back without
+# parsing. Frames are buffered in a preallocated chunk and saved once it fills.
+# The metadata is refreshed with every saved chunk, so a session that dies
+# keeps everything up to its last chunk. An existing recording is never
+# overwritten, see new_take_path for a fresh directory per take.
+class LandmarkRecorder:
+    def __init__(self, path, chunk_size=1024):
+        if is_recording(path):
+            raise FileExistsError("{} already holds a landmark recording".format(path))
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frames = 0
+        self.chunks = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._chunk = np.zeros(chunk_size, dtype=FRAME_DTYPE)
+        self._count = 0
+        self._start = None
+        self._write_meta()
+
+    # Same arguments as SharedLandmarkRing.write
+    # timestamps are stored relative to the first recorded frame
+    def write(self, faces, close, timestamp):
+        if self._start is None:
+            self._start = timestamp
+
+        slot = self._chunk[self._count]
+        slot['seq'] = self.frames
+        slot['timestamp'] = timestamp - self._start
+        slot['close'] = close
+        slot['has_face'] = len(faces) > 0
+        if len(faces) > 0:
+            face = faces[0]
+            slot['landmark'] = face['landmark']
+            slot['iris'] = face['iris']
+            slot['metric_landmarks'] = face['metric_landmarks']
+            slot['pose_transform_mat'] = face['pose_transform_mat']
+
+        self._count += 1
+        self.frames += 1
+        if self._count == self.chunk_size:
+            self._save_chunk()
+
+    def _save_chunk(self):
+        if self._count == 0:
+            return
+        np.save(os.path.join(self.path, CHUNK_FILE.format(self.chunks)), self._chunk[:self._count])
+        self.chunks += 1
+        self._count = 0
+        self._write_meta()
+
+    # frames counts the saved frames only
+    def _write_meta(self):
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path + ".tmp", 'w') as f:
+            json.dump({
+                'version': RECORDING_VERSION,
+                'frames': self.frames - self._count,
+                'chunks': self.chunks,
+                'chunk_size': self.chunk_size,
+            }, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def close(self):
+        self._save_chunk()
+
+
+# Read-only view of a recording, chunks are memory-mapped on open
+# path is a recording or a directory of takes, whose latest take is opened.
+# The chunk files on disk are authoritative, the metadata is optional.
+class LandmarkRecording:
+    def __init__(self, path):
+        path = resolve_recording(path)
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['version'] != RECORDING_VERSION:
+                raise RuntimeError("Unsupported recording version {}".format(meta['version']))
+
+        self.path = path
+        self.chunks = []
+        while os.path.isfile(os.path.join(path, CHUNK_FILE.format(len(self.chunks)))):
+            self.chunks.append(np.load(os.path.join(path, CHUNK_FILE.format(len(self.chunks))), mmap_mode='r'))
+        self._offsets = np.cumsum([0] + [len(chunk) for chunk in self.chunks])
+        self.timestamps = np.concatenate([chunk['timestamp'] for chunk in self.chunks]) \
+            if len(self.chunks) > 0 else np.empty(0)
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        chunk = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return self.chunks[chunk][index - self._offsets[chunk]]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    # faces list of one record, in the format produced by capturePipeline
+    # the arrays are read-only views into the memory-mapped chunk
+    @staticmethod
+    def faces(record):
+        if not record['has_face']:
+            return []
+        return [{
+            'landmark': record['landmark'],
+            'iris': record['iris'],
+            'metric_landmarks': record['metric_landmarks'],
+            'pose_transform_mat': record['pose_transform_mat'],
+            'timestamp': float(record['timestamp']),
+        }]
+
+
+# Plays a recording back through the capture() contract of asyncCapture
+# realtime: frames are released following their recorded timestamps, frames
+# that are late are skipped; otherwise every call returns the next frame
+class ReplayCapture:
+    def __init__(self, path, realtime=True, loop=False):
+        self.recording = LandmarkRecording(path)
+        self.realtime = realtime
+        self.loop = loop
+
+        self.position = 0
+        self.played = 0
+        self.skipped = 0
+        self._start = None
+
+    @property
+    def finished(self):
+        return not self.loop and self.position >= len(self.recording)
+
+    def _next_index(self):
+        n = len(self.recording)
+        if n == 0:
+            return None
+
+        if self.position >= n:
+            if not self.loop:
+                return None
+            self.position = 0
+            self._start = None
+
+        if not self.realtime:
+            return self.position
+
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now - self.recording.timestamps[self.position]
+
+        # newest frame whose timestamp has passed
+        index = int(np.searchsorted(self.recording.timestamps, now - self._start, side='right')) - 1
+        if index < self.position:
+            return None
+        return index
+
+    def capture(self, show_cam=False):
+        index = self._next_index()
+        if index is None:
+            return [], False
+
+        self.skipped += index - self.position
+        self.played += 1
+        self.position = index + 1
+
+        record = self.recording[index]
+        return LandmarkRecording.faces(record), bool(record['close'])
+
+    def stats(self):
+        return {
+            'replay': {
+                'position': self.position,
+                'frames': len(self.recording),
+                'played': self.played,
+                'skipped': self.skipped,
+            },
+        }
+
+    def stop(self):
+        self.recording = None
+
+
+def replayCapture(path, realtime=True, loop=False):
+    return ReplayCapture(path, realtime, loop)
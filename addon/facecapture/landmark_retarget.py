@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from . import landmarks as lm
+
+
+TRIANGLES = np.array(lm.faces, dtype=np.int32)
+SHAPE_KEY_NAME = "facecapture_landmarks"
+
+
+# Closest point of every point (n, 3) on each of its triangles (n, t, 3, 3)
+# returns squared distances (n, t) and barycentric coordinates (n, t, 3)
+def closest_on_triangles(points, triangles):
+    a, b, c = triangles[:, :, 0], triangles[:, :, 1], triangles[:, :, 2]
+    ab, ac = b - a, c - a
+    p = points[:, None, :]
+    ap = p - a
+
+    def dot(x, y):
+        return np.einsum('ntj,ntj->nt', x, y)
+
+    d00, d01, d11 = dot(ab, ab), dot(ab, ac), dot(ac, ac)
+    d20, d21 = dot(ap, ab), dot(ap, ac)
+    denom = d00 * d11 - d01 * d01
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = (d11 * d20 - d01 * d21) / denom
+        w = (d00 * d21 - d01 * d20) / denom
+    u = 1.0 - v - w
+    inside = (u >= 0) & (v >= 0) & (w >= 0) & (denom > 0)
+
+    # outside the triangle the closest point is on one of its edges
+    def segment(start, end, i, j):
+        edge = end - start
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = dot(p - start, edge) / dot(edge, edge)
+        t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+        coords = np.zeros(t.shape + (3,))
+        coords[..., i] = 1.0 - t
+        coords[..., j] = t
+        return coords
+
+    best_d2 = np.where(inside, 0.0, np.inf)
+    best = np.stack([u, v, w], axis=-1)
+    for coords in (segment(a, b, 0, 1), segment(b, c, 1, 2), segment(c, a, 2, 0)):
+        closest = np.einsum('ntk,ntkj->ntj', coords, triangles)
+        d2 = np.sum((p - closest) ** 2, axis=-1)
+        better = (d2 < best_d2) & ~inside
+        best_d2 = np.where(better, d2, best_d2)
+        best = np.where(better[..., None], coords, best)
+
+    # distance to the plane for points above the triangle
+    plane = np.einsum('ntk,ntkj->ntj', best, triangles)
+    best_d2 = np.where(inside, np.sum((p - plane) ** 2, axis=-1), best_d2)
+    return best_d2, best
+
+
+# Sparse embedding of target vertices in the landmark triangles
+# Every bound vertex follows the closest point of its nearest landmark
+# triangle through that point's barycentric coordinates, scaled by a gaussian
+# falloff of its distance to the landmark surface (radius 0 disables it).
+# Vertices whose weight falls below min_weight are not bound, so the mapping
+# only covers the face region. A frame is one gather and weighted sum over
+# (bound vertices, 3) indices, the sparse product of the (3m, 468) matrix.
+class LandmarkMapping:
+    # rest_landmarks (468, 3) and rest_vertices (nverts, 3) are local to their
+    # meshes, placed in the world by the 4x4 landmark_matrix and target_matrix
+    def __init__(self, rest_landmarks, rest_vertices, landmark_matrix=None, target_matrix=None,
+                 radius=0.0, min_weight=1e-3, candidates=16, chunk=256):
+        landmark_matrix = np.identity(4) if landmark_matrix is None else np.asarray(landmark_matrix, dtype=np.float64)
+        target_matrix = np.identity(4) if target_matrix is None else np.asarray(target_matrix, dtype=np.float64)
+
+        self.rest_landmarks = np.array(rest_landmarks, dtype=np.float32)
+        self.rest_vertices = np.array(rest_vertices, dtype=np.float32)
+        # maps landmark mesh displacements into target mesh space
+        self.linear = (np.linalg.inv(target_matrix[:3, :3]) @ landmark_matrix[:3, :3]).astype(np.float32)
+
+        # the embedding is computed in world space
+        def to_world(coords, matrix):
+            return coords.astype(np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+
+        world_vertices = to_world(self.rest_vertices, target_matrix)
+        triangles = to_world(self.rest_landmarks, landmark_matrix)[TRIANGLES]
+        centers = triangles.mean(axis=1)
+        radii = np.linalg.norm(triangles - centers[:, None], axis=-1).max(axis=1)
+        candidates_count = min(candidates, len(triangles))
+        nverts = len(self.rest_vertices)
+        nearest = np.empty(nverts, dtype=np.int64)
+        distance = np.empty(nverts)
+        bary = np.empty((nverts, 3))
+        for start in range(0, nverts, chunk):
+            points = world_vertices[start:start + chunk]
+            rows = np.arange(len(points))
+            # the nearest triangle is searched among those whose bounding
+            # spheres come closest; points farther from it than the last
+            # candidate's sphere are searched again among all triangles
+            bound = np.linalg.norm(points[:, None] - centers, axis=-1) - radii
+            candidates = np.argpartition(bound, candidates_count - 1, axis=1)[:, :candidates_count]
+            d2, coords = closest_on_triangles(points, triangles[candidates])
+            best = np.argmin(d2, axis=1)
+
+            triangle = candidates[rows, best]
+            d2, coords = d2[rows, best], coords[rows, best]
+            # bounds are signed (negative inside a sphere), clamped before squaring
+            limit = np.maximum(np.max(bound[rows[:, None], candidates], axis=1), 0.0)
+            unsure = np.flatnonzero(d2 > limit ** 2)
+            if len(unsure) and candidates_count < len(triangles):
+                all_d2, all_coords = closest_on_triangles(points[unsure], np.broadcast_to(triangles, (len(unsure),) + triangles.shape))
+                best = np.argmin(all_d2, axis=1)
+                triangle[unsure] = best
+                d2[unsure] = all_d2[np.arange(len(unsure)), best]
+                coords[unsure] = all_coords[np.arange(len(unsure)), best]
+
+            nearest[start:start + chunk] = triangle
+            distance[start:start + chunk] = np.sqrt(d2)
+            bary[start:start + chunk] = coords
+
+        falloff = np.ones(nverts) if radius <= 0 else np.exp(-(distance / radius) ** 2)
+        bound = falloff >= min_weight
+
+        self.vertex_index = np.flatnonzero(bound).astype(np.int32)
+        self.landmark_index = TRIANGLES[nearest[bound]]
+        self.weights = (bary[bound] * falloff[bound, None]).astype(np.float32)
+
+        self.coords = self.rest_vertices.copy()
+        self._displacement = np.empty((len(self.vertex_index), 3), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.vertex_index)
+
+    # Target vertex coordinates (nverts, 3) for landmarks (468, 3) in landmark
+    # mesh space; the returned array is reused by the next call
+    def deform(self, landmarks):
+        delta = (np.asarray(landmarks, dtype=np.float32) - self.rest_landmarks) @ self.linear.T
+        np.einsum('mk,mkj->mj', self.weights, delta[self.landmark_index], out=self._displacement)
+
+        np.copyto(self.coords, self.rest_vertices)
+        self.coords[self.vertex_index] += self._displacement
+        return self.coords
+
+
+# Mappings by (landmark mesh, target mesh) datablock
+_mappings = {}
+
+
+def _basis_coords(obj):
+    data = obj.data
+    coords = np.empty(3 * len(data.vertices), dtype=np.float32)
+    if data.shape_keys is None:
+        data.vertices.foreach_get('co', coords)
+    else:
+        data.shape_keys.key_blocks[0].data.foreach_get('co', coords)
+    return coords.reshape(-1, 3)
+
+
+# Builds the mapping of target_obj onto the current shape of landmark_obj
+# Both are compared in world space, so the landmark mesh must be placed over
+# the target face; its current vertices become the rest pose
+def bind(landmark_obj, target_obj, radius=0.0):
+    mapping = LandmarkMapping(
+        _basis_coords(landmark_obj), _basis_coords(target_obj),
+        np.array(landmark_obj.matrix_world), np.array(target_obj.matrix_world), radius)
+    _mappings[(landmark_obj.data.as_pointer(), target_obj.data.as_pointer())] = mapping
+    return mapping
+
+
+def invalidate_mappings():
+    _mappings.clear()
+
+
+# Mapping stored by bind, None when the meshes were never bound or the target
+# vertex count changed since; binding is left to the operator, as it takes
+# too long for a capture frame
+def get_mapping(landmark_obj, target_obj):
+    mapping = _mappings.get((landmark_obj.data.as_pointer(), target_obj.data.as_pointer()))
+    if mapping is None or len(mapping.rest_vertices) != len(target_obj.data.vertices):
+        return None
+    return mapping
+
+
+# Deforms target_obj from the landmarks through a dedicated shape key, so
+# the target's own shape keys keep working on top of it
+def apply(mapping, target_obj, landmarks):
+    if target_obj.data.shape_keys is None:
+        target_obj.shape_key_add(name='Basis', from_mix=False)
+    key_blocks = target_obj.data.shape_keys.key_blocks
+    shape_key = key_blocks.get(SHAPE_KEY_NAME)
+    if shape_key is None:
+        shape_key = target_obj.shape_key_add(name=SHAPE_KEY_NAME, from_mix=False)
+        shape_key.value = 1.0
+
+    shape_key.data.foreach_set('co', mapping.deform(landmarks).reshape(-1))
+    target_obj.data.update_tag()
@@ -4,26 +4,98 @@ import cv2
 import numpy as np
 import mediapipe as mp
 
-from .facegeometry import get_metric_landmarks, PCF, canonical_metric_landmarks, procrustes_landmark_basis
-
-
-#função  para capturar face assincronamente usando mediapipe
-# retorna função para realizar captura e função para liberar recursos
+from .facegeometry import get_metric_landmarks, get_metric_landmarks_batch, PCF, canonical_metric_landmarks, procrustes_landmark_basis
+from .landmark_buffer import LandmarkBuffer, NUM_FACE_LANDMARKS
+from .frame_source import FrameNotReady, open_source
+from .face_roi import FaceROI
+from .preview import PreviewWindow
+from . import profiling
+
+
+# Arestas dos contornos do FaceMesh e pontos das íris, usados na pré-visualização
+FACE_CONTOUR_EDGES = np.array(sorted(mp.solutions.face_mesh.FACEMESH_CONTOURS), dtype=np.int32)
+LEFT_IRIS = [473, 474,475, 476, 477]
+RIGHT_IRIS = [468, 469, 470, 471, 472]
+
+
+# Desenha pontos, contornos e íris de uma face na imagem BGR espelhada
+# points: (n, 3) normalizados ao quadro inteiro
+def draw_face(image, points, color=(224, 224, 224)):
+    img_h, img_w = image.shape[:2]
+    mesh_points = (points[:, :2] * (img_w, img_h)).astype(np.int32)
+
+    inside = (mesh_points[:, 0] >= 0) & (mesh_points[:, 0] < img_w) & (mesh_points[:, 1] >= 0) & (mesh_points[:, 1] < img_h)
+    image[mesh_points[inside, 1], mesh_points[inside, 0]] = color
+    cv2.polylines(image, list(mesh_points[FACE_CONTOUR_EDGES]), False, color, 1)
+
+    if len(mesh_points) > RIGHT_IRIS[-1]:
+        cv2.polylines(image, [mesh_points[LEFT_IRIS]], True, (0,255,0), 1, cv2.LINE_AA)
+        cv2.polylines(image, [mesh_points[RIGHT_IRIS]], True, (0,255,0), 1, cv2.LINE_AA)
+
+
+# Sessão persistente do mediapipe FaceMesh
+# O grafo é construído uma única vez e reutilizado a cada quadro, permitindo
+# que o rastreamento (min_tracking_confidence) aproveite o histórico anterior
+class FaceMeshSession:
+    def __init__(self,
+                 max_num_faces=1,
+                 refine_landmarks=True,
+                 min_detection_confidence=0.5,
+                 min_tracking_confidence=0.5):
+        self.max_num_faces = max_num_faces
+        self.face_mesh = mp.solutions.face_mesh.FaceMesh(
+            max_num_faces=max_num_faces,
+            refine_landmarks=refine_landmarks,
+            min_detection_confidence=min_detection_confidence,
+            min_tracking_confidence=min_tracking_confidence
+        )
+
+    def process(self, image):
+        if self.face_mesh is None:
+            raise RuntimeError("FaceMesh session is closed")
+        return self.face_mesh.process(image)
+
+    # Descarta o histórico de rastreamento: o próximo quadro passa pela detecção
+    def reset(self):
+        if self.face_mesh is not None:
+            self.face_mesh.reset()
+
+    def close(self):
+        if self.face_mesh is not None:
+            self.face_mesh.close()
+            self.face_mesh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#função para montar o pipeline de captura usando mediapipe
+# retorna funções para ler um quadro da fonte, processar um quadro
+# e liberar recursos, para que cada etapa possa rodar em uma thread própria
+# source: índice da câmera, arquivo de vídeo, diretório de imagens ou FrameSource
+# roi: recorta a região da face do quadro anterior antes da inferência
+# inference_size: maior lado da imagem enviada ao FaceMesh (0 mantém a resolução)
 # lança excessão em caso de falha
-def asyncCapture(camera_index):
-    # Inicialização do contexto mediapipe
-    mp_drawing = mp.solutions.drawing_utils
-    mp_face_mesh = mp.solutions.face_mesh
-
-    drawing_spec = mp_drawing.DrawingSpec(thickness=1, circle_radius=1)
-    cap = cv2.VideoCapture(camera_index)
+# out: optional (468, 3) array the metric landmarks of a single face are
+# written to instead of a new array every frame
+# max_num_faces: faces detected per frame; several are solved in one batch
+# blocking: off, read() raises FrameNotReady while no file frame is due
+def capturePipeline(source, realtime=False, roi=False, inference_size=0, out=None, max_num_faces=1, blocking=True):
+    source = open_source(source, realtime, blocking=blocking)
+    session = FaceMeshSession(max_num_faces)
+    # landmarks of every face are decoded into this buffer, reused every frame
+    buffer = LandmarkBuffer(session.max_num_faces)
 
     points_idx = [33, 263, 61, 291, 199]
     points_idx = points_idx + [key for (key, val) in procrustes_landmark_basis]
     points_idx = list(set(points_idx))
     points_idx.sort()
 
-    frame_height, frame_width, channels = (480, 640, 3)
+    # camera model built from the size the source actually delivers
+    frame_height, frame_width = source.frame_size
 
     focal_length = frame_width
     center = (frame_width / 2, frame_height / 2)
@@ -37,20 +109,31 @@ def asyncCapture(camera_index):
 
     pcf = PCF(near=1, far=10000, frame_height=frame_height, frame_width=frame_width, fy=camera_matrix[1, 1])
 
-    def getRigidInfo( faces ):
+    # region fed to the FaceMesh; without roi tracking it stays the full frame
+    face_roi = FaceROI(frame_height, frame_width)
+    roi = roi and session.max_num_faces == 1
+
+    # started the first time show_cam is set
+    preview = None
+
+    # 'landmark' and 'iris' are views into the landmark buffer, 'metric_landmarks'
+    # a view of out when given
+    def getRigidInfo( points ):
 
-        iris_landmarks = faces.landmark[468:]
-        face_landmarks = faces.landmark[:468]
+        iris_landmarks = points[NUM_FACE_LANDMARKS:]
+        face_landmarks = points[:NUM_FACE_LANDMARKS]
 
-        landmarks = np.array([(lm.x, lm.y, lm.z) for lm in face_landmarks]).T
+        landmarks = face_landmarks.T.astype(np.float64)
 
-        metric_landmarks, pose_transform_mat = get_metric_landmarks(landmarks.copy(), pcf)
+        metric_landmarks, pose_transform_mat = get_metric_landmarks(landmarks, pcf, out)
 
         return {
-            'landmark': landmarks.T,
+            'landmark': face_landmarks,
             'iris': iris_landmarks ,
             'metric_landmarks': metric_landmarks,
+            'pose_transform_mat': pose_transform_mat,
         }
+
         #model_points = metric_landmarks[0:3, points_idx].T
         #image_points = landmarks[0:2, points_idx].T * np.array([frame_width, frame_height])[None, :]
         #success, rotation_vector, translation_vector = cv2.solvePnP(
@@ -72,69 +155,101 @@ def asyncCapture(camera_index):
         #    }
         #return 45
 
+    # same as getRigidInfo for several faces, solved in one batch
+    def getRigidInfoBatch( points ):
+        landmarks = np.stack([p[:NUM_FACE_LANDMARKS].T for p in points]).astype(np.float64)
+
+        metric_landmarks, pose_transform_mat = get_metric_landmarks_batch(landmarks, pcf)
+
+        return [{
+            'landmark': p[:NUM_FACE_LANDMARKS],
+            'iris': p[NUM_FACE_LANDMARKS:],
+            'metric_landmarks': metric_landmarks[i],
+            'pose_transform_mat': pose_transform_mat[i],
+        } for i, p in enumerate(points)]
+
+
+    # returns (image, timestamp)
+    def read():
+        with profiling.span('read'):
+            return source.read()
+
+    def process(image, show_cam = False, timestamp = None):
+        nonlocal preview
+
+        # only the region is flipped and converted to RGB, not the whole frame
+        box = face_roi.box
+        with profiling.span('convert'):
+            rgb = face_roi.crop(image, inference_size)
+
+        rgb.flags.writeable = False
+        with profiling.span('inference'):
+            results = session.process(rgb)
+
+        faces = []
+        points = []
+
+        if results.multi_face_landmarks:
+
+            with profiling.span('landmarks'):
+                points = [buffer.fill(i, face_landmarks) for i, face_landmarks in enumerate(results.multi_face_landmarks)]
+                if box is not None:
+                    # landmarks are normalised to the crop, map them to the frame
+                    for p in points:
+                        face_roi.reproject(p, box)
+                if roi:
+                    face_roi.update(points[0][:NUM_FACE_LANDMARKS])
+
+            with profiling.span('metric'):
+                if len(points) > 1:
+                    faces = getRigidInfoBatch(points)
+                else:
+                    faces = list(map(getRigidInfo, points))
+            for face in faces:
+                face['timestamp'] = timestamp
+        else:
+            # face lost, search the whole frame again
+            face_roi.reset()
+
+        # the preview thread mirrors and draws the BGR frame on its own time,
+        # here it only receives the frame and a copy of the landmarks; the
+        # window is shown by update_windows() on the main thread
+        if show_cam and preview is None:
+            preview = PreviewWindow(draw_face)
+        close = False
+        if preview is not None:
+            preview.set_visible(show_cam)
+            if show_cam:
+                preview.submit(image, points)
+            close = preview.consume_closed()
+
+        # Retorno das faces econtradas e do sinal de parada caso
+        # janela de exibição seja fechada
+        return faces, close
+
+    def release():
+        source.release()
+        session.close()
+        if preview is not None:
+            preview.stop()
+
+    return read, process, release
+
+
+#função  para capturar face assincronamente usando mediapipe
+# retorna função para realizar captura e função para liberar recursos
+# lança excessão em caso de falha
+def asyncCapture(source, realtime=False, roi=False, inference_size=0, out=None, max_num_faces=1):
+    # runs on Blender's main thread: a file frame that is not due yet is
+    # reported as no new frame, as threaded capture does, instead of waited for
+    read, process, release = capturePipeline(source, realtime, roi, inference_size, out, max_num_faces, blocking=False)
 
     def capture(show_cam = False):
-        with mp_face_mesh.FaceMesh(
-            refine_landmarks=True,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        ) as face_mesh:
-
-            if cap.isOpened():
-                success, image = cap.read()
-                if not success:
-                    raise RuntimeError("Falha ao iniciar câmera")
-
-                image = cv2.cvtColor(cv2.flip(image, 1), cv2.COLOR_BGR2RGB)
-
-                image.flags.writeable = False
-                results = face_mesh.process(image)
-
-                image.flags.writeable = True
-                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-
-                LEFT_IRIS = [473, 474,475, 476, 477]
-                RIGHT_IRIS = [468, 469, 470, 471, 472]
-                img_h, img_w = image.shape[:2]
-                faces = []
-                close = False
-
-                if results.multi_face_landmarks:
-
-                    faces = list(map(getRigidInfo, results.multi_face_landmarks))
-
-                    if show_cam:
-                        for face_landmarks in results.multi_face_landmarks:
-                            # image = cv2.blur(image, (30, 30))
-                            mp_drawing.draw_landmarks(
-                                image=image,
-                                landmark_list=face_landmarks,
-                                #connections=mp_face_mesh.FACE_CONNECTIONS,
-                                connections=mp_face_mesh.FACEMESH_CONTOURS,
-                                landmark_drawing_spec=drawing_spec,
-                                connection_drawing_spec=drawing_spec
-                            )
-                            mesh_points = np.array([np.multiply([p.x, p.y], [img_w, img_h]).astype(int) for p in face_landmarks.landmark])
-                            cv2.polylines(image, [mesh_points[LEFT_IRIS]], True, (0,255,0), 1, cv2.LINE_AA)
-                            cv2.polylines(image, [mesh_points[RIGHT_IRIS]], True, (0,255,0), 1, cv2.LINE_AA)
-
-                        cv2.namedWindow("Face", cv2.WINDOW_NORMAL)
-                        # cv2.resizeWindow("Face", 800, 600)
-                        cv2.imshow('Face', image)
-                        if cv2.waitKey(1) & 0xFF == 27:
-                            close = True
-                    else:
-                        cv2.destroyAllWindows()
-
-                # Retorno das faces econtradas e do sinal de parada caso
-                # janela de exibição seja fechada
-                return faces, close
-
-        raise RuntimeError("Falha ao iniciar câmera")
-
-    def endCapture():
-        cap.release()
-        cv2.destroyAllWindows()
-
-    return capture, endCapture
+        try:
+            image, timestamp = read()
+        except FrameNotReady:
+            return [], False
+        return process(image, show_cam, timestamp)
+
+    return capture, release
 
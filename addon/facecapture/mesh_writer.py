@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from .landmark_buffer import NUM_FACE_LANDMARKS
+
+
+# Writes captured landmarks to the landmark mesh from one persistent buffer
+# The buffer is a C-contiguous float32 (468, 3) array, the layout and type
+# foreach_set('co') takes without converting. Passing it as out to the
+# capture pipeline makes get_metric_landmarks write straight into it, any
+# other face is copied in. An optional temporal filter smooths the buffer in
+# place before it is written. Only coordinates change, so the mesh is tagged for
+# the depsgraph instead of running Mesh.update().
+class MeshWriter:
+    def __init__(self, num_vertices=NUM_FACE_LANDMARKS):
+        self.buffer = np.zeros((num_vertices, 3), dtype=np.float32)
+        self._flat = self.buffer.reshape(-1)
+
+    # face['metric_landmarks'] is (3, 468); returns the buffer, which the next
+    # write overwrites
+    def write(self, data, face, landmark_filter=None, timestamp=None):
+        metric_landmarks = face['metric_landmarks']
+        if metric_landmarks.base is not self.buffer:
+            np.copyto(self.buffer, metric_landmarks.T)
+        if landmark_filter is not None:
+            landmark_filter.filter(self.buffer, timestamp, out=self.buffer)
+
+        data.vertices.foreach_set('co', self._flat)
+        data.update_tag()
+        return self.buffer
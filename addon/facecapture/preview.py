@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import traceback
+
+import cv2
+
+
+# Camera preview drawn by its own thread, away from the capture hot path
+# submit() only keeps a reference to the newest frame and a copy of its
+# landmarks; the preview thread mirrors and draws it at most rate times per
+# second, skipping frames in between. HighGUI must run on the main thread
+# (on macOS anything else aborts the host application), so the window itself
+# is only created, updated and destroyed by update_windows(), which the owner
+# of the main thread calls regularly, e.g. from Blender's modal timer.
+class PreviewWindow:
+    def __init__(self, draw, name="Face", rate=15.0):
+        self.name = name
+        self.rate = rate
+        self._draw = draw
+
+        self._latest = None
+        self._drawn = None
+        self._ready = threading.Condition()
+        self._visible = False
+        self._open = False
+        self._closed = False
+        self._running = True
+        self._last_poll = 0.0
+
+        self.submitted = 0
+        self.shown = 0
+
+        with _windows_lock:
+            _windows.append(self)
+
+        self._thread = threading.Thread(target=self._loop, name="facecapture-preview", daemon=True)
+        self._thread.start()
+
+    # image: BGR frame as read from the source (not mirrored)
+    # points: list of (n, 3) landmark arrays normalised to the mirrored frame,
+    # copied here because the landmark buffer is reused by the next frame
+    def submit(self, image, points):
+        with self._ready:
+            self._latest = (image, [p.copy() for p in points])
+            self.submitted += 1
+            self._ready.notify()
+
+    def set_visible(self, visible):
+        if visible != self._visible:
+            with self._ready:
+                self._visible = visible
+                self._latest = None
+                self._drawn = None
+                self._ready.notify()
+
+    # True once after the user closed the window with Esc
+    def consume_closed(self):
+        closed, self._closed = self._closed, False
+        return closed
+
+    def _render(self, frame):
+        image, points = frame
+        image = cv2.flip(image, 1)
+        for face_points in points:
+            self._draw(image, face_points)
+        return image
+
+    def _loop(self):
+        period = 1.0 / self.rate
+        try:
+            while self._running:
+                t0 = time.perf_counter()
+                with self._ready:
+                    if self._latest is None:
+                        self._ready.wait(period)
+                    frame, self._latest = self._latest, None
+                    visible = self._visible
+
+                if frame is None or not visible:
+                    continue
+
+                image = self._render(frame)
+                with self._ready:
+                    if self._visible:
+                        self._drawn = image
+
+                # throttle, newer frames replace older ones meanwhile
+                delay = period - (time.perf_counter() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception:
+            traceback.print_exc()
+
+    # Main thread only: shows the last drawn frame, polls the window for Esc
+    # at the preview rate and destroys it once hidden or stopped
+    # returns False once the window is gone for good
+    def update(self):
+        with self._ready:
+            image, self._drawn = self._drawn, None
+            visible = self._visible and self._running
+
+        if not visible:
+            if self._open:
+                cv2.destroyWindow(self.name)
+                cv2.waitKey(1)
+                self._open = False
+            return self._running
+
+        now = time.perf_counter()
+        if image is not None:
+            if not self._open:
+                cv2.namedWindow(self.name, cv2.WINDOW_NORMAL)
+                self._open = True
+            cv2.imshow(self.name, image)
+            self.shown += 1
+        elif not self._open or now - self._last_poll < 1.0 / self.rate:
+            return True
+
+        self._last_poll = now
+        if cv2.waitKey(1) & 0xFF == 27:
+            self._closed = True
+        return True
+
+    def stats(self):
+        return {'submitted': self.submitted, 'shown': self.shown}
+
+    # the window is destroyed by the next update_windows()
+    def stop(self):
+        self._running = False
+        with self._ready:
+            self._ready.notify()
+        self._thread.join(timeout=1.0)
+
+
+# Preview windows not destroyed yet, in creation order
+_windows = []
+_windows_lock = threading.Lock()
+
+
+# Runs the HighGUI side of every preview window; call from the main thread
+def update_windows():
+    with _windows_lock:
+        windows = list(_windows)
+
+    for window in windows:
+        try:
+            alive = window.update()
+        except cv2.error:
+            # e.g. OpenCV built without GUI support
+            traceback.print_exc()
+            window._running = False
+            alive = False
+        if not alive:
+            with _windows_lock:
+                _windows.remove(window)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# Stages timed along the capture path, in pipeline order
+STAGES = (
+    'read',
+    'convert',
+    'inference',
+    'landmarks',
+    'metric',
+    'mesh',
+    'insert',
+    'weights',
+    'retarget',
+    'keyframes',
+    'frame',
+)
+
+
+# Rolling window of the last durations of one stage, in nanoseconds
+class StageHistogram:
+    def __init__(self, window=512):
+        self.durations = np.zeros(window, dtype=np.int64)
+        self.count = 0
+
+    def add(self, duration):
+        self.durations[self.count % len(self.durations)] = duration
+        self.count += 1
+
+    def values(self):
+        return self.durations[:min(self.count, len(self.durations))]
+
+    # (p50, p95, p99) in milliseconds
+    def percentiles(self):
+        values = self.values()
+        if len(values) == 0:
+            return 0.0, 0.0, 0.0
+        return tuple(np.percentile(values, (50, 95, 99)) / 1e6)
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, self.start, time.perf_counter_ns())
+
+
+# Collects perf_counter_ns spans of the capture stages
+# Every stage keeps a rolling histogram; with trace set, spans are also kept
+# as Chrome trace events (chrome://tracing, ui.perfetto.dev) up to max_events.
+class Profiler:
+    def __init__(self, window=512, trace=False, max_events=1000000):
+        self.window = window
+        self.stages = {}
+        self.counters = {}
+        self.trace = trace
+        self.events = collections.deque(maxlen=max_events)
+        self._frames = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def add(self, name, start, end):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = StageHistogram(self.window)
+            histogram.add(end - start)
+            if self.trace:
+                self.events.append((name, start, end, threading.get_ident()))
+
+    def span(self, name):
+        return _Span(self, name)
+
+    # marks the end of a frame delivered to Blender, for the fps estimate
+    def frame(self):
+        self._frames.append(time.perf_counter_ns())
+
+    def fps(self):
+        if len(self._frames) < 2:
+            return 0.0
+        return (len(self._frames) - 1) * 1e9 / (self._frames[-1] - self._frames[0])
+
+    # {stage: (count, p50, p95, p99)} in pipeline order, times in milliseconds
+    def summary(self):
+        with self._lock:
+            names = sorted(self.stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES))
+            return {name: (self.stages[name].count,) + self.stages[name].percentiles() for name in names}
+
+    def export_chrome_trace(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': [{
+                    'name': name,
+                    'ph': 'X',
+                    'ts': start / 1000.0,
+                    'dur': (end - start) / 1000.0,
+                    'pid': self._pid,
+                    'tid': tid,
+                } for name, start, end, tid in events],
+                'displayTimeUnit': 'ms',
+            }, f)
+        return len(events)
+
+    def print_summary(self):
+        print("{:10s} {:>8s} {:>10s} {:>10s} {:>10s}".format("stage", "count", "p50 ms", "p95 ms", "p99 ms"))
+        for name, (count, p50, p95, p99) in self.summary().items():
+            print("{:10s} {:8d} {:10.3f} {:10.3f} {:10.3f}".format(name, count, p50, p95, p99))
+        print("{:10.1f} fps".format(self.fps()))
+
+
+_profiler = None
+_null_span = contextlib.nullcontext()
+
+
+def enable(window=512, trace=False):
+    global _profiler
+    _profiler = Profiler(window, trace)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def get_profiler():
+    return _profiler
+
+
+# Span on the active profiler, or a shared no-op context when profiling is off
+def span(name):
+    profiler = _profiler
+    if profiler is None:
+        return _null_span
+    return profiler.span(name)
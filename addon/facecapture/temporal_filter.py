@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import math
+
+import numpy as np
+
+
+# Element-wise filters over arrays of any fixed shape, e.g. (468, 3) metric
+# landmarks or the shape key weights
+# filter(x, timestamp) returns the filtered values in a buffer owned by the
+# filter (or out), reused by the next call. State is allocated on the first
+# call and again only when the shape of x changes, which also resets it.
+# Timestamps are in seconds; when missing or not increasing the step falls
+# back to default_dt.
+class TemporalFilter:
+    def __init__(self, default_dt=1.0 / 30.0):
+        self.default_dt = default_dt
+        self._started = False
+        self._last = None
+        self._shape = None
+
+    def reset(self):
+        self._started = False
+
+    # time step since the previous call, None on the first one
+    def _step(self, x, timestamp):
+        if self._shape != x.shape:
+            self._shape = x.shape
+            self._allocate(x.shape)
+            self._started = False
+
+        if not self._started:
+            self._started = True
+            self._last = timestamp
+            return None
+
+        dt = self.default_dt
+        if timestamp is not None and self._last is not None and timestamp > self._last:
+            dt = timestamp - self._last
+        self._last = timestamp
+        return dt
+
+    def _allocate(self, shape):
+        raise NotImplementedError
+
+    def filter(self, x, timestamp=None, out=None):
+        raise NotImplementedError
+
+
+# One Euro filter (Casiez et al. 2012): a low pass whose cutoff rises with the
+# filtered speed, so slow jitter is smoothed while fast motion keeps little lag
+# min_cutoff (Hz) sets the smoothing at rest, lower is smoother and slower;
+# beta sets how fast the cutoff opens up with speed.
+class OneEuroFilter(TemporalFilter):
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0, default_dt=1.0 / 30.0):
+        super().__init__(default_dt)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+
+    def _allocate(self, shape):
+        self._x = np.zeros(shape)
+        self._dx = np.zeros(shape)
+        self._work = np.empty(shape)
+        self._alpha = np.empty(shape)
+
+    def filter(self, x, timestamp=None, out=None):
+        dt = self._step(x, timestamp)
+        if dt is None:
+            np.copyto(self._x, x)
+            self._dx.fill(0.0)
+        else:
+            # speed, smoothed with the fixed derivative cutoff
+            np.subtract(x, self._x, out=self._work)
+            self._work /= dt
+            self._work -= self._dx
+            self._work *= 1.0 / (1.0 + 1.0 / (2.0 * math.pi * self.d_cutoff * dt))
+            self._dx += self._work
+
+            # alpha = 1 / (1 + tau / dt) = 1 - 1 / (1 + 2 pi cutoff dt)
+            np.abs(self._dx, out=self._alpha)
+            self._alpha *= self.beta
+            self._alpha += self.min_cutoff
+            self._alpha *= 2.0 * math.pi * dt
+            self._alpha += 1.0
+            np.reciprocal(self._alpha, out=self._alpha)
+            np.subtract(1.0, self._alpha, out=self._alpha)
+
+            np.subtract(x, self._x, out=self._work)
+            self._work *= self._alpha
+            self._x += self._work
+
+        if out is None:
+            return self._x
+        np.copyto(out, self._x)
+        return out
+
+
+# Constant velocity Kalman filter run independently on every element
+# process_noise is the variance rate of the (white) acceleration, larger
+# follows motion faster; measurement_noise the variance of the measurements,
+# larger smooths more. With one step and one noise model for all elements
+# their covariances stay equal, so it is kept as three scalars and only
+# position and velocity are arrays.
+class KalmanFilter(TemporalFilter):
+    def __init__(self, process_noise=1.0, measurement_noise=1e-2, default_dt=1.0 / 30.0):
+        super().__init__(default_dt)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+
+    def _allocate(self, shape):
+        self._x = np.zeros(shape)
+        self._v = np.zeros(shape)
+        self._innovation = np.empty(shape)
+        self._work = np.empty(shape)
+
+    def filter(self, x, timestamp=None, out=None):
+        dt = self._step(x, timestamp)
+        if dt is None:
+            np.copyto(self._x, x)
+            self._v.fill(0.0)
+            # position as uncertain as a measurement, velocity unknown
+            self._pxx, self._pxv, self._pvv = self.measurement_noise, 0.0, self.measurement_noise / self.default_dt ** 2
+        else:
+            q = self.process_noise
+            pxx, pxv, pvv = self._pxx, self._pxv, self._pvv
+
+            # predict
+            np.multiply(self._v, dt, out=self._work)
+            self._x += self._work
+            pxx = pxx + 2.0 * dt * pxv + dt * dt * pvv + q * dt ** 3 / 3.0
+            pxv = pxv + dt * pvv + q * dt * dt / 2.0
+            pvv = pvv + q * dt
+
+            # update
+            s = pxx + self.measurement_noise
+            kx, kv = pxx / s, pxv / s
+            np.subtract(x, self._x, out=self._innovation)
+            np.multiply(self._innovation, kx, out=self._work)
+            self._x += self._work
+            np.multiply(self._innovation, kv, out=self._work)
+            self._v += self._work
+            self._pxx, self._pxv, self._pvv = (1.0 - kx) * pxx, (1.0 - kx) * pxv, pvv - kv * pxv
+
+        if out is None:
+            return self._x
+        np.copyto(out, self._x)
+        return out
+
+
+FILTERS = {
+    'ONE_EURO': OneEuroFilter,
+    'KALMAN': KalmanFilter,
+}